@@ -1 +1 @@
-from .util import readline_google_store, StreamInterruptionError
+from .util import readline_google_store, iter_record_batches, iter_raw_blocks, StreamInterruptionError
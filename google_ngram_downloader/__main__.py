@@ -1,40 +1,256 @@
 import gzip
+import json
 import sys
+import time
 from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
 from itertools import islice
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 from opster import Dispatcher
 from py.path import local
 
-from .util import iter_google_store, readline_google_store, count_coccurrence
+from .util import (
+    readline_google_store,
+    aggregate_records,
+    count_coccurrence_batches,
+    download_google_store,
+    google_store_manifest,
+    google_store_urls,
+    iter_raw_blocks,
+    iter_record_batches,
+    Progress,
+    get_indices,
+    partition_indices,
+    GzipWriter,
+    PairCounter,
+    PackedCounter,
+    BatchChunks,
+    ShardCache,
+    SketchCounter,
+    SpillingCounter,
+    Stats,
+    Vocabulary,
+    emit_stats,
+    _stats_hooks,
+    frequent_words,
+    read_cooccurrence_binary,
+    word_to_id,
+    write_cooccurrence_binary,
+)
 
 
 dispatcher = Dispatcher()
 command = dispatcher.command
 
+COUNTERS = {
+    'dict': PairCounter,
+    'packed': PackedCounter,
+}
+
+STATS_OPTION = ('', False, 'Print the time spent in the pipeline stages to stderr.')
+PREFETCH_OPTION = ('', 16, 'The number of chunks of 1 MB downloaded ahead in the background, 0 disables.')
+WORKER_ID_OPTION = ('', 0, 'The id of this worker from 0 to the number of workers - 1.')
+NUM_WORKERS_OPTION = ('', 1, 'The number of workers the files are split between, balancing the amount of data.')
+CACHE_DIR_OPTION = ('', '', 'The folder to keep the read files in and read them from next time.')
+CACHE_SIZE_OPTION = ('', 0.0, 'The size of the cache in GB, the least recently used files are removed. 0 for no limit.')
+MANIFEST_OPTION = (
+    '',
+    '',
+    'The file written by the manifest command. If not given, the file sizes are requested from the server.',
+)
+
+
+@contextmanager
+def report_stats(enabled):
+    """Collect the measurements of the pipeline stages and print them to stderr at the end."""
+    if not enabled:
+        yield None
+        return
+
+    with Stats() as stats:
+        try:
+            yield stats
+        finally:
+            sys.stderr.write(stats.summary())
+
 
 @command()
 def download(
     ngram_len=('n', 1, 'The length of ngrams to be downloaded.'),
     output=('o', 'downloads/google_ngrams/{ngram_len}', 'The destination folder for downloaded files.'),
     verbose=('v', False, 'Be verbose.'),
+    rewrite=('r', False, 'Download existing files from scratch.'),
     lang=(
         'l',
         'eng',
         'Language. [eng|eng-us|eng-gb|eng-fiction|chi-sim|fre|ger|heb|ita|rus|spa]',
     ),
+    jobs=('j', 1, 'The number of files downloaded in parallel.'),
+    retries=('', 3, 'The number of times a failed download is retried.'),
+    progress_log=('', '', 'The file to append the progress to as JSON lines.'),
+    segments=('s', 1, 'The number of connections a file is downloaded over, each fetching a part of it.'),
+    worker_id=WORKER_ID_OPTION,
+    num_workers=NUM_WORKERS_OPTION,
+    manifest=MANIFEST_OPTION,
+    stats=STATS_OPTION,
 ):
     """Download The Google Books Ngram Viewer dataset version 20120701."""
     output = local(output.format(ngram_len=ngram_len))
     output.ensure_dir()
 
-    for fname, url, request in iter_google_store(ngram_len, verbose=verbose, lang=lang):
-        with output.join(fname).open('wb') as f:
-            for num, chunk in enumerate(request.iter_content(1024)):
-                if verbose and not divmod(num, 1024)[1]:
-                    sys.stderr.write('.')
-                    sys.stderr.flush()
-                f.write(chunk)
+    sizes, progress = None, None
+    with report_stats(stats):
+        indices = worker_indices(ngram_len, lang, worker_id, num_workers, manifest, jobs)
+
+        if verbose or progress_log or manifest:
+            entries = load_manifest(ngram_len, lang, manifest, jobs, indices)
+            sizes = dict((entry['url'], entry['size']) for entry in entries)
+
+        if verbose or progress_log:
+            progress = Progress(
+                total_size=sum(size or 0 for size in sizes.values()),
+                stream=sys.stderr if verbose else None,
+                log=open(progress_log, 'a') if progress_log else None,
+            )
+
+        downloads = download_google_store(
+            ngram_len, str(output), lang=lang, indices=indices, jobs=jobs, retries=retries, rewrite=rewrite,
+            sizes=sizes, progress=progress, segments=segments,
+        )
+
+        try:
+            for _ in downloads:
+                pass
+        finally:
+            if progress_log:
+                progress.log.close()
+
+
+def make_cache(cache_dir, cache_size):
+    """Create a :class:`ShardCache` if the cache folder is set."""
+    if not cache_dir:
+        return None
+    return ShardCache(cache_dir, max_size=int(cache_size * 1024 ** 3) or None)
+
+
+def load_manifest(ngram_len, lang, manifest, jobs, indices=None):
+    """Read the manifest file or request the sizes of the files if it's not given."""
+    if not manifest:
+        return google_store_manifest(ngram_len, lang=lang, indices=indices, jobs=jobs)
+
+    with open(manifest) as f:
+        entries = [json.loads(line) for line in f]
+
+    if indices is not None:
+        indices = set(indices)
+        entries = [entry for entry in entries if entry['index'] in indices]
+    return entries
+
+
+def worker_indices(ngram_len, lang, worker_id, num_workers, manifest, jobs):
+    """The indices of the files processed by a worker, `None` if there is a single worker."""
+    if num_workers == 1:
+        return None
+
+    assert 0 <= worker_id < num_workers, 'The worker id has to be less than the number of workers.'
+    entries = load_manifest(ngram_len, lang, manifest, jobs)
+
+    return partition_indices([(entry['index'], entry['size']) for entry in entries], num_workers)[worker_id]
+
+
+@command()
+def index(
+    ngram_len=('n', 1, 'The length of ngrams.'),
+    data_dir=('d', 'downloads/google_ngrams/{ngram_len}', 'The folder of the downloaded files.'),
+    lang=(
+        'l',
+        'eng',
+        'Language. [eng|eng-us|eng-gb|eng-fiction|chi-sim|fre|ger|heb|ita|rus|spa]',
+    ),
+    spacing=('', 1024, 'The distance between the checkpoints in KB of uncompressed data.'),
+    rewrite=('r', False, 'Index the files that are already indexed.'),
+    verbose=('v', False, 'Be verbose.'),
+    stats=STATS_OPTION,
+):
+    """Index the downloaded files for random access to ngrams."""
+    from .index import build_index, is_indexed
+
+    data_dir = local(data_dir.format(ngram_len=ngram_len))
+
+    with report_stats(stats):
+        for fname, _ in google_store_urls(ngram_len, lang=lang):
+            path = data_dir.join(fname)
+            if not path.check():
+                continue
+
+            if not rewrite and is_indexed(str(path)):
+                if verbose:
+                    print('Skipping {}'.format(path))
+                continue
+
+            if verbose:
+                print('Indexing {}'.format(path))
+            build_index(str(path), spacing=spacing * 1024)
+
+
+@command()
+def lookup(
+    ngram_len=('n', 1, 'The length of ngrams.'),
+    data_dir=('d', 'downloads/google_ngrams/{ngram_len}', 'The folder of the downloaded and indexed files.'),
+    lang=(
+        'l',
+        'eng',
+        'Language. [eng|eng-us|eng-gb|eng-fiction|chi-sim|fre|ger|heb|ita|rus|spa]',
+    ),
+    input=('i', '', 'The file with the ngrams to look up, one per line, the standard input by default.'),
+    aggregate=('a', False, 'Print the total counts of an ngram instead of the counts per year.'),
+    stats=STATS_OPTION,
+):
+    """Print the records of the ngrams read from the input."""
+    from .index import NgramLookup
+
+    f = open(input, encoding='utf-8') if input else sys.stdin
+    try:
+        ngrams = [line.rstrip('\n') for line in f if line.strip()]
+    finally:
+        if input:
+            f.close()
+
+    with report_stats(stats), NgramLookup(ngram_len, data_dir.format(ngram_len=ngram_len), lang=lang) as engine:
+        for records in engine.lookup_many(ngrams).values():
+            if aggregate:
+                records = aggregate_records(records)
+
+            for record in records:
+                print(u'{ngram}\t{year}\t{match_count}\t{volume_count}'.format(**record._asdict()))
+
+
+@command()
+def manifest(
+    ngram_len=('n', 1, 'The length of ngrams.'),
+    output=('o', '', 'The file to write the manifest to, the standard output by default.'),
+    lang=(
+        'l',
+        'eng',
+        'Language. [eng|eng-us|eng-gb|eng-fiction|chi-sim|fre|ger|heb|ita|rus|spa]',
+    ),
+    jobs=('j', 1, 'The number of HEAD requests issued in parallel.'),
+    stats=STATS_OPTION,
+):
+    """Write the sizes and the ETags of the collection files as JSON lines."""
+    with report_stats(stats):
+        entries = google_store_manifest(ngram_len, lang=lang, jobs=jobs)
+
+    f = open(output, 'w') if output else sys.stdout
+    try:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    finally:
+        if output:
+            f.close()
 
 
 @command()
@@ -48,49 +264,479 @@ def cooccurrence(
         50000000,
         'The number of records to be read from the Google store to store in a .json.gz file.',
     ),
+    memory_budget=(
+        '',
+        0.0,
+        'Start a new output file once the counts take this many GB of memory instead of after --records-in-file '
+        'records. An output file is written while the next one is counted, so up to twice as much is used. '
+        '0 disables.',
+    ),
     lang=(
         'l',
         'eng',
         'Language. [eng|eng-us|eng-gb|eng-fiction|chi-sim|fre|ger|heb|ita|rus|spa]',
     ),
+    workers=('w', 1, 'The number of files processed in parallel by separate processes.'),
+    counter=(
+        '',
+        ('dict', 'packed', 'sketch'),
+        'The cooccurrence counter. [dict|packed|sketch] A packed counter takes several times less memory. '
+        'A sketch counter keeps only the --top-pairs pairs with approximate counts in fixed memory.',
+    ),
+    sketch_width=('', 2 ** 22, 'The number of counters in a row of the sketch, a counter takes 8 bytes.'),
+    sketch_depth=('', 4, 'The number of rows of the sketch.'),
+    top_pairs=('', 1000000, 'The number of the most frequent pairs written by a sketch counter.'),
+    vocab_size=('', 0, 'Count only the pairs of this many most frequent words in the 1-grams. 0 disables.'),
+    min_count=('', 0, 'Count only the pairs of the words with at least this total match count in the 1-grams.'),
+    max_pairs=(
+        '',
+        0,
+        'Count every file to a single output file, spilling the counts to disk once there are this many pairs '
+        'in memory. 0 disables.',
+    ),
+    tmp_dir=('', '', 'The folder for spilled counts, the system default if not set.'),
+    vocabulary=(
+        '',
+        '',
+        'The file of a vocabulary shared by all the output files, which then contain word ids instead of words.',
+    ),
+    output_format=(
+        'f',
+        ('tsv', 'binary'),
+        'The output format. [tsv|binary] The binary files can be memory mapped with read_cooccurrence_binary().',
+    ),
+    sort=('', False, 'Sort the binary output by the ids.'),
+    compression_level=('', 6, 'The compression level of the output from 1 (fast) to 9 (small).'),
+    writer_threads=('', 4, 'The number of threads compressing the output.'),
+    years=('', '', 'Keep only the records of the years in a range, for example 1900-1999.'),
+    min_match_count=('', 0, 'Keep only the records with at least this match count.'),
+    prefix=('', '', 'Keep only the ngrams that start with the prefix.'),
+    pattern=('', '', 'Keep only the ngrams that contain a match of the regular expression.'),
+    exclude_pos=('', False, 'Skip the ngrams with part of speech tags.'),
+    prefetch=PREFETCH_OPTION,
+    cache_dir=CACHE_DIR_OPTION,
+    cache_size=CACHE_SIZE_OPTION,
+    worker_id=WORKER_ID_OPTION,
+    num_workers=NUM_WORKERS_OPTION,
+    manifest=MANIFEST_OPTION,
+    stats=STATS_OPTION,
 ):
-    """Write the cooccurrence frequencies of a word and its contexts."""
+    """Write the cooccurrence frequencies of a word and its contexts.
+
+    The files can be split between several machines with --num-workers, then
+    the outputs are combined with the merge command.
+
+    """
     assert ngram_len > 1
     output_dir = local(output.format(ngram_len=ngram_len))
     output_dir.ensure_dir()
 
-    for fname, _, all_records in readline_google_store(ngram_len, lang=lang,  verbose=verbose):
-        postfix = 0
+    if memory_budget:
+        assert not max_pairs, 'The memory of spilling counters is bounded by --max-pairs.'
+        records_in_file = None
+        memory_budget = int(memory_budget * 1024 ** 3)
+    else:
+        memory_budget = None
+
+    if max_pairs:
+        records_in_file = None
+        make_counter = partial(SpillingCounter, max_pairs, directory=tmp_dir or None)
+    elif counter == 'sketch':
+        make_counter = partial(SketchCounter, sketch_width, sketch_depth, top_pairs)
+    else:
+        make_counter = COUNTERS[counter]
+
+    if vocabulary:
+        assert workers == 1, 'A vocabulary can not be shared between worker processes.'
+        vocabulary = Vocabulary(vocabulary)
+    else:
+        vocabulary = None
+
+    stream_options = dict(
+        make_filters(years, min_match_count, prefix, pattern, exclude_pos),
+        prefetch=prefetch,
+        cache=make_cache(cache_dir, cache_size),
+    )
+
+    known_words = None
+    if vocab_size or min_count:
+        if verbose:
+            print('Ranking the words of the 1-grams')
+        known_words = frequent_words(
+            lang=lang, vocab_size=vocab_size, min_count=min_count, prefetch=prefetch, cache=stream_options['cache'],
+        )
+
+    options = dict(
+        output_dir=output_dir,
+        rewrite=rewrite,
+        records_in_file=records_in_file,
+        memory_budget=memory_budget,
+        make_counter=make_counter,
+        vocabulary=vocabulary,
+        output_format=output_format,
+        sort=sort,
+        verbose=verbose,
+        compression_level=compression_level,
+        writer_threads=writer_threads,
+    )
+
+    with report_stats(stats) as collected:
+        indices = worker_indices(ngram_len, lang, worker_id, num_workers, manifest, workers)
+
+        if workers == 1:
+            checkpoints = resume_files(output_dir, ngram_len, lang, indices, rewrite, verbose)
+            all_files = iter_record_batches(
+                ngram_len, lang=lang, indices=indices, verbose=verbose,
+                skip=dict((fname, c['records']) for fname, c in checkpoints.items()), **stream_options
+            )
+            for fname, _, batches in all_files:
+                cooccurrence_file(
+                    fname, batches, checkpoint=checkpoints.get(fname), known_words=known_words, **options
+                )
+            return
+
+        worker = partial(
+            cooccurrence_worker, ngram_len=ngram_len, lang=lang, stream_options=stream_options, stats=stats, **options
+        )
+        # The worker function is sent with every file, the words are sent to every process once.
+        pool = Pool(workers, initializer=init_cooccurrence_worker, initargs=(known_words, ))
+        try:
+            # The files are handed out one by one, the results are collected in
+            # the order of the indices and an error in a worker stops the run.
+            if indices is None:
+                indices = get_indices(ngram_len)
+
+            for _, worker_stats in pool.imap(worker, indices, chunksize=1):
+                if worker_stats:
+                    collected.update(worker_stats)
+        finally:
+            pool.terminate()
+
+
+_worker_known_words = None
+
+
+def init_cooccurrence_worker(known_words):
+    """Set the `known_words` of :func:`cooccurrence_file` in a worker process."""
+    global _worker_known_words
+    _worker_known_words = known_words
+
+
+def cooccurrence_worker(index, ngram_len, lang, stream_options, stats=False, **options):
+    """Process the file with the given index, the entry point of worker processes.
+
+    The `stream_options` are passed to :func:`iter_record_batches`, the
+    known words are set by :func:`init_cooccurrence_worker`.
+
+    :returns: a pair of the list of written files and the measurements of
+        the pipeline stages, see :meth:`Stats.as_dict`, if `stats` is set.
+
+    """
+    if stats:
+        with Stats() as collected:
+            output_files, _ = cooccurrence_worker(index, ngram_len, lang, stream_options, **options)
+        return output_files, collected.as_dict()
+
+    checkpoints = resume_files(
+        options['output_dir'], ngram_len, lang, [index], options['rewrite'], options['verbose'],
+    )
+
+    output_files = []
+    all_files = iter_record_batches(
+        ngram_len, lang=lang, indices=[index],
+        skip=dict((fname, c['records']) for fname, c in checkpoints.items()), **stream_options
+    )
+    for fname, _, batches in all_files:
+        output_files.extend(
+            cooccurrence_file(
+                fname, batches, checkpoint=checkpoints.get(fname), known_words=_worker_known_words, **options
+            )
+        )
+
+    return output_files, None
+
+
+def cooccurrence_file(
+    fname, batches, output_dir, rewrite, records_in_file, make_counter, vocabulary, output_format, sort, verbose,
+    compression_level=6, writer_threads=4, checkpoint=None, known_words=None, memory_budget=None,
+):
+    """Write the cooccurrence counts of a single file of the collection.
+
+    The record batches of the file are counted with :func:`count_coccurrence_batches`.
+    The counts of every `records_in_file` records are written to a separate
+    file, all the records are counted together if it's `None`. If
+    `memory_budget` is given instead, an output file is written once its
+    counter takes this many bytes, see :class:`BatchChunks`. If a
+    :class:`Vocabulary` is given, word ids are written instead of words. If
+    `known_words` are given, the pairs of the other words are not counted.
+
+    The binary output is written with :func:`write_cooccurrence_binary`, if
+    there is no shared vocabulary the words of the ids are written to a
+    `.vocab` file next to it.
+
+    An output file is written by a background thread while the following
+    records are counted. A checkpoint is saved before the first output file
+    and after every one of them, see :func:`resume_files`. If a `checkpoint`
+    is given, the records before it are expected to be skipped already. The
+    checkpoint is removed when the file is complete, then the existing
+    output files tell that it's done.
+
+    :returns: the list of written files.
+
+    """
+    checkpoint_file = output_dir.join(fname + CHECKPOINT_EXTENSION)
+    resumed = checkpoint is not None
+    if checkpoint is None:
+        checkpoint = {'postfix': 0, 'records': 0}
+
+    output_files = []
+
+    chunks = BatchChunks(batches, records_in_file, memory_budget)
+
+    writer = ThreadPool(1)
+    written = None
+    try:
+        postfix = checkpoint['postfix']
         while (True):
-            records = islice(all_records, records_in_file)
             output_file = output_dir.join(
-                '{fname}_{postfix}.gz'.format(
+                '{fname}_{postfix}.{extension}'.format(
                     fname=fname,
                     postfix=postfix,
+                    extension='gz' if output_format == 'tsv' else 'bin',
                 )
             )
 
-            if not rewrite and output_file.check():
+            if not rewrite and not resumed and output_file.check():
+                # The output of a version that didn't write checkpoints.
                 if verbose:
                     print('Skipping {} and the rest...'.format(output_file))
                 break
 
-            index = OrderedDict()
-            cooccurrence = count_coccurrence(records, index)
+            counter = make_counter()
+            index = OrderedDict() if vocabulary is None else vocabulary
+            cooccurrence = count_coccurrence_batches(
+                chunks.take(counter), index, counter=counter, known_words=known_words,
+            )
 
-            if not cooccurrence:
+            if not chunks.records:
+                if written is not None:
+                    written.get()
+                if checkpoint_file.check():
+                    checkpoint_file.remove()
                 break
 
-            id2word = list(index)
-            items = (u'{}\t{}\t{}\n'.format(id2word[i], id2word[c], str(v)) for (i, c), v in cooccurrence.items())
+            if not cooccurrence:
+                # All the ngrams of the chunk are out of the vocabulary, there is nothing to write.
+                if records_in_file or memory_budget:
+                    if written is not None:
+                        written.get()
+                    checkpoint = {'postfix': postfix, 'records': checkpoint['records'] + chunks.records}
+                    save_checkpoint(checkpoint_file, checkpoint)
+                continue
 
-            with gzip.open(str(output_file), 'wb') as f:
-                if verbose:
-                    print('Writing {}'.format(output_file))
-                for item in items:
-                    f.write(item.encode('utf8'))
+            if vocabulary is not None:
+                # The vocabulary is saved first, so the ids in the output are always known.
+                vocabulary.save()
+
+            if verbose:
+                print('Writing {}'.format(output_file))
+                if isinstance(cooccurrence, SketchCounter):
+                    print(
+                        'The counts are overestimated by at most {:.0f} with the probability of {:.2%}'
+                        ''.format(*cooccurrence.bounds())
+                    )
+
+            if written is not None:
+                # At most one output file is waiting to be written.
+                written.get()
+
+            if (records_in_file or memory_budget) and not resumed and written is None:
+                # Without a checkpoint the first output file would mark the whole file as done.
+                save_checkpoint(checkpoint_file, checkpoint)
 
             postfix += 1
+            if records_in_file or memory_budget:
+                checkpoint = {'postfix': postfix, 'records': checkpoint['records'] + chunks.records}
+            else:
+                # All the records are in a single file, there is nothing to resume.
+                checkpoint = None
+
+            words = None if vocabulary is not None else list(index)
+            written = writer.apply_async(
+                write_cooccurrence_chunk,
+                (output_file, cooccurrence, words, checkpoint_file, checkpoint),
+                dict(
+                    output_format=output_format,
+                    sort=sort,
+                    compression_level=compression_level,
+                    writer_threads=writer_threads,
+                ),
+            )
+
+            output_files.append(str(output_file))
+
+        if written is not None:
+            written.get()
+    finally:
+        writer.terminate()
+
+    return output_files
+
+
+def write_cooccurrence_chunk(output_file, cooccurrence, words, checkpoint_file, checkpoint, **options):
+    """Write an output file and then the checkpoint after it."""
+    write_cooccurrence_file(output_file, cooccurrence, words, **options)
+    if checkpoint is not None:
+        save_checkpoint(checkpoint_file, checkpoint)
+
+
+CHECKPOINT_EXTENSION = '.checkpoint.json'
+
+
+def save_checkpoint(path, checkpoint):
+    part = path.new(basename=path.basename + '.part')
+    part.write(json.dumps(checkpoint))
+    part.rename(path)
+
+
+def resume_files(output_dir, ngram_len, lang, indices, rewrite, verbose):
+    """Decide which files have to be processed by looking at their checkpoints.
+
+    A checkpoint is saved after every output file of :func:`cooccurrence_file`,
+    it contains the number of the records processed so far and the postfix
+    of the next output file. The records before a checkpoint are skipped
+    without parsing them.
+
+    The file is downloaded and decompressed again from its start. Resuming
+    in the middle of the compressed data would need the state of the
+    decompressor at a record boundary, which `zlib` can't export while
+    streaming. Use `--cache-dir` to read the file from the disk instead of
+    the network.
+
+    :returns: a dictionary of the checkpoints by the file names.
+
+    """
+    checkpoints = {}
+    if rewrite:
+        return checkpoints
+
+    for fname, _ in google_store_urls(ngram_len, lang=lang, indices=indices):
+        checkpoint_file = output_dir.join(fname + CHECKPOINT_EXTENSION)
+
+        if checkpoint_file.check():
+            checkpoint = checkpoints[fname] = json.loads(checkpoint_file.read())
+            if verbose:
+                print('Resuming {} after {} records'.format(fname, checkpoint['records']))
+
+    return checkpoints
+
+
+def write_cooccurrence_file(output_file, cooccurrence, words, output_format, sort, compression_level, writer_threads):
+    """Write the counts to a file.
+
+    :param words: the words of the ids, if `None` the ids are written.
+
+    """
+    started = time.perf_counter()
+
+    # The data is written to a temporary file first, so an output file is always complete.
+    part = output_file.new(basename=output_file.basename + '.part')
+
+    if output_format == 'binary':
+        if words is not None:
+            vocab = output_file.new(ext='.vocab')
+            vocab_part = vocab.new(basename=vocab.basename + '.part')
+            with vocab_part.open('w', encoding='utf-8') as f:
+                f.writelines(u'{}\n'.format(word) for word in words)
+            vocab_part.rename(vocab)
+
+        pairs = write_cooccurrence_binary(str(part), cooccurrence.items(), sort=sort)
+
+    else:
+        if words is not None:
+            items = (u'{}\t{}\t{}\n'.format(words[i], words[c], v) for (i, c), v in cooccurrence.items())
+        else:
+            items = (u'{}\t{}\t{}\n'.format(i, c, v) for (i, c), v in cooccurrence.items())
+
+        pairs = 0
+        with GzipWriter(str(part), level=compression_level, threads=writer_threads) as f:
+            while True:
+                lines = list(islice(items, 2 ** 16))
+                if not lines:
+                    break
+                pairs += len(lines)
+                f.write(u''.join(lines).encode('utf8'))
+
+    part.rename(output_file)
+    if _stats_hooks:
+        emit_stats('write', time.perf_counter() - started, bytes_out=output_file.size(), records=pairs)
+
+
+@command()
+def merge(
+    inputs=('i', '', 'Comma separated folders with the cooccurrence files to merge.'),
+    output=('o', 'cooccurrence.gz', 'The merged file.'),
+    verbose=('v', False, 'Be verbose.'),
+    counter=('', ('dict', 'packed'), 'The cooccurrence counter. [dict|packed]'),
+    max_pairs=('', 0, 'Spill the counts to disk once there are this many pairs in memory. 0 disables.'),
+    tmp_dir=('', '', 'The folder for spilled counts, the system default if not set.'),
+    output_format=('f', ('tsv', 'binary'), 'The output format. [tsv|binary]'),
+    sort=('', False, 'Sort the binary output by the ids.'),
+    compression_level=('', 6, 'The compression level of the output from 1 (fast) to 9 (small).'),
+    writer_threads=('', 4, 'The number of threads compressing the output.'),
+    stats=STATS_OPTION,
+):
+    """Sum the counts of the cooccurrence files, for example written by several workers.
+
+    Files written with a shared vocabulary are merged by word ids, so all of
+    them have to use the same vocabulary.
+
+    """
+    assert inputs, 'Set the folders to merge.'
+    make_counter = partial(SpillingCounter, max_pairs, directory=tmp_dir or None) if max_pairs else COUNTERS[counter]
+
+    index = OrderedDict()
+    cooccurrence = make_counter()
+
+    with report_stats(stats):
+        for input_dir in inputs.split(','):
+            for path in sorted(local(input_dir).listdir(lambda p: p.ext in ('.gz', '.bin'))):
+                if verbose:
+                    print('Reading {}'.format(path))
+
+                cooccurrence.add_pairs(
+                    ((word_to_id(item, index), word_to_id(context, index)), count)
+                    for item, context, count in iter_cooccurrence_file(path)
+                )
+
+        if verbose:
+            print('Writing {}'.format(output))
+
+        write_cooccurrence_file(
+            local(output), cooccurrence, list(index), output_format, sort, compression_level, writer_threads,
+        )
+
+
+def iter_cooccurrence_file(path):
+    """Iterate over the `(item, context, count)` triples of a file written by :func:`write_cooccurrence_file`.
+
+    The ids of a binary file without a `.vocab` file are returned as strings.
+
+    """
+    if path.ext == '.bin':
+        matrix = read_cooccurrence_binary(str(path))
+
+        vocab = path.new(ext='.vocab')
+        word = vocab.read_text('utf-8').split(u'\n').__getitem__ if vocab.check() else str
+
+        for item, context, count in zip(matrix.item_ids, matrix.context_ids, matrix.counts):
+            yield word(item), word(context), count
+
+    else:
+        with gzip.open(str(path), 'rb') as f:
+            for line in f:
+                item, context, count = line.decode('utf-8').rstrip(u'\n').split(u'\t')
+                yield item, context, int(count)
 
 
 @command()
@@ -101,9 +747,106 @@ def readline(
         'eng',
         'Language. [eng|eng-us|eng-gb|eng-fiction|chi-sim|fre|ger|heb|ita|rus|spa]',
     ),
+    indices=('', '', 'Comma separated indices of the files to read, all the files by default.'),
+    years=('', '', 'Keep only the records of the years in a range, for example 1900-1999.'),
+    min_match_count=('', 0, 'Keep only the records with at least this match count.'),
+    prefix=('', '', 'Keep only the ngrams that start with the prefix.'),
+    pattern=('', '', 'Keep only the ngrams that contain a match of the regular expression.'),
+    exclude_pos=('', False, 'Skip the ngrams with part of speech tags.'),
+    aggregate=('a', False, 'Print the total counts of an ngram instead of the counts per year.'),
+    year_window=('', 0, 'Print the total counts of an ngram in windows of this many years, e.g. 10 for decades.'),
+    raw=('', False, 'Write the decompressed lines as they are without parsing them.'),
+    compress=('', 0, 'Compress the raw output with this compression level, 0 disables.'),
+    prefetch=PREFETCH_OPTION,
+    cache_dir=CACHE_DIR_OPTION,
+    cache_size=CACHE_SIZE_OPTION,
+    stats=STATS_OPTION,
 ):
     """Print the raw content."""
+    stream_options = dict(
+        make_filters(years, min_match_count, prefix, pattern, exclude_pos),
+        prefetch=prefetch,
+        cache=make_cache(cache_dir, cache_size),
+    )
+    indices = indices.split(',') if indices else None
+
+    with report_stats(stats):
+        if raw:
+            assert not (aggregate or year_window), 'The raw output can not be aggregated.'
+            readline_raw(ngram_len, lang, indices, stream_options, compress)
+            return
+
+        assert not compress, 'Only the raw output can be compressed.'
+
+        for _, _, records in readline_google_store(ngram_len, lang=lang, indices=indices, **stream_options):
+            if aggregate or year_window:
+                records = aggregate_records(records, year_window=year_window)
+
+            for record in records:
+                print(u'{ngram}\t{year}\t{match_count}\t{volume_count}'.format(**record._asdict()))
+
+
+def readline_raw(ngram_len, lang, indices, stream_options, compress):
+    """Write the decompressed lines to the standard output, optionally compressing them again."""
+    sys.stdout.flush()
+    output = sys.stdout.buffer
+
+    f = GzipWriter(fileobj=output, level=compress) if compress else output
+    for _, _, blocks in iter_raw_blocks(ngram_len, lang=lang, indices=indices, **stream_options):
+        for block in blocks:
+            f.write(block)
+            f.write(b'\n')
+
+    if compress:
+        f.close()
+    output.flush()
+
+
+def make_filters(years, min_match_count, prefix, pattern, exclude_pos):
+    """Convert the filter options to the keyword arguments of `line_filter()`."""
+    if years:
+        first_year, _, last_year = years.partition('-')
+        years = int(first_year), int(last_year or first_year)
+
+    return dict(
+        years=years or None,
+        min_match_count=min_match_count,
+        prefix=prefix or None,
+        pattern=pattern or None,
+        exclude_pos=exclude_pos,
+    )
+
+
+@command()
+def benchmark(
+    data_dir=('d', 'downloads/benchmark', 'The folder for the synthetic files.'),
+    ngram_len=('n', 2, 'The length of ngrams.'),
+    size=('s', 100.0, 'The size of a synthetic file in MB.'),
+    shards=('', 1, 'The number of synthetic files.'),
+    seed=('', 0, 'The random seed of the synthetic data.'),
+    baseline=('b', '', 'A JSON file with the results to compare with.'),
+    save=('', False, 'Save the results to the baseline file.'),
+    stats=STATS_OPTION,
+):
+    """Measure the throughput of the pipeline on synthetic data served locally."""
+    from . import benchmark as bench
+
+    with report_stats(stats):
+        results = bench.run_benchmark(
+            data_dir, ngram_len=ngram_len, size=int(size * 1024 ** 2), shards=shards, seed=seed,
+        )
+    ratios = bench.compare(results, bench.load_baseline(baseline)) if baseline and not save else {}
+
+    for name in 'download', 'readline', 'batches', 'cooccurrence':
+        result = results[name]
+        print(
+            u'{name:<14}{seconds:>10.2f} s{mb_per_s:>10.1f} MB/s{records_per_s:>14.0f} records/s{ratio}'.format(
+                name=name,
+                ratio='{:>8.2f}x'.format(ratios[name]) if name in ratios else '',
+                **result
+            )
+        )
 
-    for _, _, records in readline_google_store(ngram_len, lang=lang):
-        for record in records:
-            print(u'{ngram}\t{year}\t{match_count}\t{volume_count}'.format(**record._asdict()))
+    if save:
+        assert baseline, 'Set the baseline file to save the results to.'
+        bench.save_baseline(results, baseline)
@@ -0,0 +1,231 @@
+"""Offline benchmarks of the streaming pipeline.
+
+Synthetic files in the format of the collection are served by a local HTTP
+server that stands in for the Google store, so the measurements do not
+depend on the network and can be compared between runs.
+
+"""
+import gzip
+import json
+import os
+import random
+import shutil
+import string
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from itertools import accumulate, islice
+
+from . import util
+
+
+def generate_shard(path, ngram_len, size, vocabulary_size=100000, years=(1800, 2008), seed=0):
+    """Write a gzip file of about `size` compressed bytes in the format of the collection.
+
+    The words follow the Zipf's law, every ngram is followed by the records
+    of a random range of years.
+
+    :param str path: the output file.
+    :param int ngram_len: the length of ngrams.
+    :param int size: the size of the file.
+    :param int vocabulary_size: the number of distinct words.
+    :param years: a pair `(first, last)` of years.
+    :param seed: the random seed, the same seed gives the same file.
+
+    """
+    rng = random.Random(seed)
+    words = [
+        u''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(1, 10)))
+        for _ in range(vocabulary_size)
+    ]
+    cum_weights = list(accumulate(1.0 / rank for rank in range(1, vocabulary_size + 1)))
+
+    first_year, last_year = years
+
+    with open(path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+            while raw.tell() < size:
+                ngram = u' '.join(rng.choices(words, cum_weights=cum_weights, k=ngram_len))
+                start = rng.randint(first_year, last_year)
+
+                lines = u''.join(
+                    u'{}\t{}\t{}\t{}\n'.format(ngram, year, rng.randint(1, 1000), rng.randint(1, 100))
+                    for year in range(start, rng.randint(start, last_year) + 1)
+                )
+                f.write(lines.encode('utf-8'))
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """A static file handler that supports single range requests."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        byte_range = self.headers.get('Range')
+        path = self.translate_path(self.path)
+
+        if not byte_range or not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.send_head(self)
+
+        size = os.path.getsize(path)
+        start, _, end = byte_range[len('bytes='):].partition('-')
+        start, end = int(start), min(int(end or size - 1), size - 1)
+
+        if start >= size:
+            self.send_error(416)
+            return None
+
+        f = open(path, 'rb')
+        f.seek(start)
+
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        return _LimitedFile(f, end - start + 1)
+
+
+class _LimitedFile(object):
+    """A file that ends after `length` bytes, used to serve ranges."""
+
+    def __init__(self, f, length):
+        self.f = f
+        self.length = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.length:
+            size = self.length
+        data = self.f.read(size)
+        self.length -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+@contextmanager
+def serve(directory):
+    """Serve a folder over HTTP and point `util.URL_TEMPLATE` to it."""
+    handler = partial(RangeRequestHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    url_template = util.URL_TEMPLATE
+    util.URL_TEMPLATE = 'http://127.0.0.1:{}/{{}}'.format(server.server_address[1])
+    try:
+        yield util.URL_TEMPLATE
+    finally:
+        util.URL_TEMPLATE = url_template
+        server.shutdown()
+        server.server_close()
+
+
+def run_benchmark(data_dir, ngram_len=2, size=100 * 1024 ** 2, shards=1, seed=0):
+    """Measure the throughput of the pipeline stages on synthetic files.
+
+    The files are generated in `data_dir` unless they are already there.
+
+    :returns: a dictionary of the stage names to dictionaries with the
+        `seconds`, `bytes`, `records`, `mb_per_s` and `records_per_s` keys.
+        `bytes` is the compressed size of the files.
+
+    """
+    indices = list(islice(util.get_indices(ngram_len), shards))
+    data_dir = os.path.join(data_dir, '{}gram-{}-{}'.format(ngram_len, size, seed))
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    total_size = 0
+    for i, (fname, _) in enumerate(util.google_store_urls(ngram_len, indices=indices)):
+        path = os.path.join(data_dir, fname)
+        if not os.path.exists(path):
+            generate_shard(path + '.part', ngram_len, size, seed=seed + i)
+            os.rename(path + '.part', path)
+        total_size += os.path.getsize(path)
+
+    def count_records():
+        return sum(
+            1 for _, _, records in util.readline_google_store(ngram_len, indices=indices) for _ in records
+        )
+
+    def count_batches():
+        return sum(
+            len(batch.year)
+            for _, _, batches in util.iter_record_batches(ngram_len, indices=indices)
+            for batch in batches
+        )
+
+    def count_cooccurrence():
+        records = 0
+        for _, _, batches in util.iter_record_batches(ngram_len, indices=indices):
+            chunks = util.BatchChunks(batches)
+            util.count_coccurrence_batches(chunks.take(None), {})
+            records += chunks.records
+        return records
+
+    def download():
+        output_dir = tempfile.mkdtemp()
+        try:
+            for _ in util.download_google_store(ngram_len, output_dir, indices=indices):
+                pass
+        finally:
+            shutil.rmtree(output_dir)
+        return 0
+
+    stages = (
+        ('download', download),
+        ('readline', count_records),
+        ('batches', count_batches),
+        ('cooccurrence', count_cooccurrence),
+    )
+
+    results = {}
+    with serve(data_dir):
+        for name, stage in stages:
+            started = time.perf_counter()
+            records = stage()
+            seconds = time.perf_counter() - started
+
+            results[name] = {
+                'seconds': seconds,
+                'bytes': total_size,
+                'records': records,
+                'mb_per_s': total_size / 1024 ** 2 / seconds,
+                'records_per_s': records / seconds,
+            }
+
+    return results
+
+
+def compare(results, baseline):
+    """Compare the throughput with a baseline.
+
+    :returns: a dictionary of the stage names to the ratios of the current
+        and the baseline MB/s, above 1 is faster.
+
+    """
+    return dict(
+        (name, result['mb_per_s'] / baseline[name]['mb_per_s'])
+        for name, result in results.items()
+        if name in baseline
+    )
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,332 @@
+"""Random access to the downloaded files of the collection.
+
+A file is indexed once, then the records of an ngram are found by
+decompressing only the part of the file that may contain it.
+
+Two files are written next to the indexed file:
+
+* `<file>.gzidx`, the inflate checkpoints built by `indexed_gzip`: the
+  state of the decompressor every `spacing` bytes of uncompressed data.
+* `<file>.ngrams.json`, the smallest and the largest ngram in every
+  `spacing` bytes of uncompressed data, aligned to lines.
+
+`indexed_gzip` is an optional dependency, install it with
+``pip install google-ngram-downloader[index]``.
+
+"""
+import collections
+import json
+import os
+import time
+from bisect import bisect_right
+
+from . import util
+from .util import emit_stats, iter_records, parse_batch
+
+CHECKPOINTS_EXTENSION = '.gzidx'
+RANGES_EXTENSION = '.ngrams.json'
+INDEX_VERSION = 1
+
+
+def _indexed_gzip():
+    try:
+        import indexed_gzip
+    except ImportError:
+        raise ImportError(
+            'Indexing requires indexed_gzip, install it with `pip install google-ngram-downloader[index]`.'
+        )
+    return indexed_gzip
+
+
+def is_indexed(path):
+    """Check whether a file has an up to date index."""
+    ranges = path + RANGES_EXTENSION
+    return (
+        os.path.exists(ranges) and
+        os.path.exists(path + CHECKPOINTS_EXTENSION) and
+        os.path.getmtime(ranges) >= os.path.getmtime(path)
+    )
+
+
+def build_index(path, spacing=1024 ** 2):
+    """Index a downloaded file of the collection.
+
+    The file is decompressed once. Every `spacing` bytes of uncompressed
+    data an inflate checkpoint is stored together with the range of ngrams
+    of the lines that end in these bytes.
+
+    :param str path: the gzip file.
+    :param int spacing: the distance between checkpoints in uncompressed bytes.
+        A lookup decompresses about twice as much, the checkpoints take
+        32 KB each.
+
+    :returns: a :class:`ShardIndex`.
+
+    """
+    started = time.perf_counter()
+
+    # Every window is a tuple of the start and the end offsets of its lines
+    # and the smallest and the largest ngram among them.
+    windows = []
+    offset = 0
+    last = b''
+
+    f = _indexed_gzip().IndexedGzipFile(path, spacing=spacing)
+    try:
+        while True:
+            data = f.read(spacing)
+            if not data:
+                break
+
+            block = last + data
+            end = block.rfind(b'\n')
+            if end == -1:
+                last = block
+                offset += len(data)
+                continue
+
+            start = offset - len(last)
+            block, last = block[:end], block[end + 1:]
+            offset += len(data)
+
+            ngrams = block.replace(b'\t', b'\n').split(b'\n')[0::4]
+            windows.append((start, start + end + 1, min(ngrams).decode('utf-8'), max(ngrams).decode('utf-8')))
+
+        f.build_full_index()
+        f.export_index(path + CHECKPOINTS_EXTENSION + '.part')
+    finally:
+        f.close()
+
+    os.rename(path + CHECKPOINTS_EXTENSION + '.part', path + CHECKPOINTS_EXTENSION)
+
+    with open(path + RANGES_EXTENSION + '.part', 'w') as f:
+        json.dump(
+            {
+                'version': INDEX_VERSION,
+                'spacing': spacing,
+                'size': offset,
+                'windows': windows,
+            },
+            f,
+        )
+    os.rename(path + RANGES_EXTENSION + '.part', path + RANGES_EXTENSION)
+
+    emit_stats('index', time.perf_counter() - started, bytes_in=os.path.getsize(path), bytes_out=offset)
+
+    return ShardIndex(path)
+
+
+class ShardIndex(object):
+    """An indexed file of the collection, see :func:`build_index`.
+
+    The file is opened on the first lookup and stays open until
+    :meth:`close` is called.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path + RANGES_EXTENSION) as f:
+            meta = json.load(f)
+        assert meta['version'] == INDEX_VERSION, 'Unsupported index version {}.'.format(meta['version'])
+
+        self.spacing = meta['spacing']
+        self.size = meta['size']
+        self.windows = meta['windows']
+
+        # The files of the collection are sorted, so usually the windows don't
+        # overlap and the candidates are found by bisection.
+        self.sorted = all(w[3] <= n[2] for w, n in zip(self.windows, self.windows[1:]))
+        self.first_ngrams = [w[2] for w in self.windows]
+
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def candidates(self, ngram):
+        """The windows that may contain the ngram."""
+        if self.sorted:
+            # The records of an ngram may continue in the following windows.
+            i = max(bisect_right(self.first_ngrams, ngram) - 1, 0)
+            while i > 0 and self.windows[i - 1][3] >= ngram:
+                i -= 1
+
+            windows = []
+            for window in self.windows[i:]:
+                if window[2] > ngram:
+                    break
+                if window[3] >= ngram:
+                    windows.append(window)
+            return windows
+
+        return [w for w in self.windows if w[2] <= ngram <= w[3]]
+
+    def read(self, start, end):
+        """Read uncompressed bytes of the file."""
+        if self._file is None:
+            self._file = _indexed_gzip().IndexedGzipFile(
+                self.path,
+                index_file=self.path + CHECKPOINTS_EXTENSION,
+                spacing=self.spacing,
+                auto_build=False,
+            )
+
+        self._file.seek(start)
+        return self._file.read(end - start)
+
+    def lookup(self, ngram):
+        """Find the records of an ngram.
+
+        :param str ngram: the ngram, words are separated by spaces.
+
+        :returns: a list of :class:`Record`.
+
+        """
+        return self.lookup_many([ngram])[ngram]
+
+    def lookup_many(self, ngrams):
+        """Find the records of several ngrams, decompressing every window once.
+
+        :returns: a dictionary of the ngrams to lists of :class:`Record`.
+
+        """
+        started = time.perf_counter()
+
+        windows = collections.defaultdict(set)
+        for ngram in ngrams:
+            for start, end, _, _ in self.candidates(ngram):
+                windows[start, end].add(ngram)
+
+        results = dict((ngram, []) for ngram in ngrams)
+        nbytes, records = 0, 0
+        for (start, end), window_ngrams in sorted(windows.items()):
+            # The leading newline makes every line start after a newline.
+            block = b'\n' + self.read(start, end - 1)
+            nbytes += len(block) - 1
+
+            for ngram in window_ngrams:
+                prefix = b'\n' + ngram.encode('utf-8') + b'\t'
+
+                lines = []
+                i = block.find(prefix)
+                while i != -1:
+                    j = block.find(b'\n', i + 1)
+                    if j == -1:
+                        j = len(block)
+                    lines.append(block[i + 1:j])
+                    i = block.find(prefix, j)
+
+                if lines:
+                    results[ngram].extend(iter_records(parse_batch(b'\n'.join(lines))))
+                    records += len(lines)
+
+        emit_stats('lookup', time.perf_counter() - started, bytes_out=nbytes, records=records)
+
+        return results
+
+
+class NgramLookup(object):
+    """Look up ngrams in the indexed files of a folder.
+
+    An ngram is looked up in the file given by :func:`util.ngram_index`,
+    the files have to be downloaded and indexed with :func:`build_index`.
+    The results of the recent lookups are cached.
+
+    :param int ngram_len: the length of ngrams.
+    :param str data_dir: the folder of the downloaded files.
+    :param str lang: the language of the ngrams.
+    :param int cache_size: the number of ngrams in the cache.
+    :param int max_open: the number of files kept open.
+
+    """
+
+    def __init__(self, ngram_len, data_dir, lang='eng', cache_size=100000, max_open=16):
+        self.ngram_len = ngram_len
+        self.data_dir = data_dir
+        self.lang = lang
+        self.cache_size = cache_size
+        self.max_open = max_open
+
+        self.indices = set(util.get_indices(ngram_len))
+        self.cache = collections.OrderedDict()
+        self.shards = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        while self.shards:
+            _, shard = self.shards.popitem()
+            shard.close()
+
+    def shard(self, index):
+        """Open the indexed file with the given index."""
+        shard = self.shards.pop(index, None)
+
+        if shard is None:
+            path = os.path.join(
+                self.data_dir,
+                util.FILE_TEMPLATE.format(lang=self.lang, ngram_len=self.ngram_len, version='20120701', index=index),
+            )
+            if not is_indexed(path):
+                raise IOError('{} is not downloaded or indexed, see the index command.'.format(path))
+            shard = ShardIndex(path)
+
+            if len(self.shards) >= self.max_open:
+                _, closed = self.shards.popitem(last=False)
+                closed.close()
+
+        self.shards[index] = shard
+        return shard
+
+    def lookup(self, ngram):
+        """Find the records of an ngram, see :meth:`lookup_many`."""
+        return self.lookup_many([ngram])[ngram]
+
+    def lookup_many(self, ngrams):
+        """Find the records of the ngrams.
+
+        The ngrams that are not in the cache are grouped by file, so every
+        window of a file is decompressed once.
+
+        :returns: an ordered dictionary of the ngrams to lists of :class:`Record`.
+
+        """
+        results = collections.OrderedDict((ngram, None) for ngram in ngrams)
+
+        by_index = collections.defaultdict(list)
+        for ngram in results:
+            records = self.cache.pop(ngram, None)
+            if records is None:
+                by_index[util.ngram_index(ngram, self.ngram_len)].append(ngram)
+                self.misses += 1
+            else:
+                results[ngram] = self.cache[ngram] = records
+                self.hits += 1
+
+        for index, index_ngrams in sorted(by_index.items()):
+            found = self.shard(index).lookup_many(index_ngrams) if index in self.indices else {}
+
+            for ngram in index_ngrams:
+                results[ngram] = self.cache[ngram] = tuple(found.get(ngram, ()))
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return collections.OrderedDict((ngram, list(records)) for ngram, records in results.items())
@@ -1,10 +1,30 @@
 import collections
+import gzip
+import heapq
+import io
+import json
+import math
+import mmap
+import os
+import queue
+import random
+import re
+import struct
 import sys
+import tempfile
+import threading
+import time
 import zlib
-from itertools import product, chain, groupby
-from string import ascii_lowercase, digits
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from itertools import accumulate, product, chain, groupby, islice
+from multiprocessing.pool import ThreadPool
+from operator import attrgetter
+from string import ascii_lowercase, digits, punctuation
 
 import requests
+from requests.adapters import HTTPAdapter
 
 
 URL_TEMPLATE = 'http://storage.googleapis.com/books/ngrams/books/{}'
@@ -15,103 +35,1488 @@ FILE_TEMPLATE = 'googlebooks-{lang}-all-{ngram_len}gram-{version}-{index}.gz'
 
 Record = collections.namedtuple('Record', 'ngram year match_count volume_count')
 
+# A column oriented block of records. The UTF-8 encoded ngrams are
+# concatenated in `ngrams`, the i-th ngram is `ngrams[offsets[i]:offsets[i + 1]]`.
+RecordBatch = collections.namedtuple('RecordBatch', 'ngrams offsets year match_count volume_count')
+
+
+# A part of speech tag, either attached to a word (book_NOUN) or on its own (_NOUN_).
+POS_TAG = re.compile(br'_(?:ADJ|ADP|ADV|CONJ|DET|NOUN|NUM|PRON|PRT|VERB|X|\.|ROOT|START|END)_?(?= |$)')
+
+# The columns of a binary cooccurrence file, see `read_cooccurrence_binary()`.
+CooccurrenceMatrix = collections.namedtuple('CooccurrenceMatrix', 'item_ids context_ids counts sorted')
+
+# The magic string, the format version, the flags (1 if the pairs are sorted)
+# and the number of pairs. The header is padded to keep the columns aligned.
+BINARY_HEADER = '<4sIIQ4x'
+BINARY_MAGIC = b'GNDC'
+BINARY_VERSION = 1
+
 
 class StreamInterruptionError(Exception):
     """Raised when a data stream ends before the end of the file"""
 
-    def __init__(self, url, message):
-        self.url = url
-        self.message = message
+    def __init__(self, url, message):
+        self.url = url
+        self.message = message
+
+
+# The functions called with the measurements of the pipeline stages, see `add_stats_hook()`.
+_stats_hooks = []
+
+
+def add_stats_hook(hook):
+    """Register a function to be called with the measurements of the pipeline stages.
+
+    The hook is called as `hook(stage, seconds, bytes_in, bytes_out, records)`
+    once per chunk, batch or file, depending on the stage:
+
+    * `network`: the time spent waiting for compressed data.
+    * `inflate`: the decompression of the compressed data.
+    * `filter`: the filtering of raw lines, see :func:`line_filter`.
+    * `split`: the splitting of lines to fields.
+    * `parse`: the conversion of the fields to integers.
+    * `count`: the cooccurrence counting, without the stages above.
+    * `write`: the writing of output files.
+    * `download`: the download of a file to disk.
+    * `head`: a HEAD request.
+    * `index`: the indexing of a downloaded file, see :func:`index.build_index`.
+    * `lookup`: a lookup of an ngram in an indexed file.
+
+    The hooks are called from the thread doing the work. Nothing is measured
+    while there are no hooks.
+
+    """
+    _stats_hooks.append(hook)
+
+
+def remove_stats_hook(hook):
+    """Unregister a function registered with :func:`add_stats_hook`."""
+    _stats_hooks.remove(hook)
+
+
+def emit_stats(stage, seconds, bytes_in=0, bytes_out=0, records=0):
+    """Pass a measurement to the registered hooks."""
+    for hook in _stats_hooks:
+        hook(stage, seconds, bytes_in, bytes_out, records)
+
+
+def readline_google_store(
+    ngram_len, lang='eng', indices=None, chunk_size=1024 ** 2, verbose=False, prefetch=0, cache=None, skip=None,
+    **filters
+):
+    """Iterate over the data in the Google ngram collectioin.
+
+        :param int ngram_len: the length of ngrams to be streamed.
+        :param str lang: the langueage of the ngrams.
+        :param iter indices: the file indices to be downloaded.
+        :param int chunk_size: the size the chunks of raw compressed data.
+        :param bool verbose: if `True`, then the debug information is shown to `sys.stderr`.
+        :param int prefetch: the number of chunks downloaded ahead by a background thread, see :func:`prefetch_files`.
+        :param cache: a :class:`ShardCache` to read the files from and to store them in.
+        :param dict skip: the numbers of lines to skip at the start of the files by the file names,
+            the lines are counted after filtering.
+        :param filters: the filters applied to the raw lines, see :func:`line_filter`.
+
+        :returns: a iterator over triples `(fname, url, records)`
+
+    """
+    batches = iter_record_batches(
+        ngram_len, lang=lang, indices=indices, chunk_size=chunk_size, verbose=verbose, prefetch=prefetch, cache=cache,
+        skip=skip, **filters
+    )
+
+    for fname, url, file_batches in batches:
+        yield fname, url, chain.from_iterable(map(iter_records, file_batches))
+
+
+def iter_record_batches(
+    ngram_len, lang='eng', indices=None, chunk_size=1024 ** 2, verbose=False, prefetch=0, cache=None, skip=None,
+    **filters
+):
+    """Iterate over the data in the Google ngram collection in batches.
+
+    Every chunk of compressed data is decompressed and parsed at once to a
+    :class:`RecordBatch`.
+
+        :param int ngram_len: the length of ngrams to be streamed.
+        :param str lang: the langueage of the ngrams.
+        :param iter indices: the file indices to be downloaded.
+        :param int chunk_size: the size the chunks of raw compressed data.
+        :param bool verbose: if `True`, then the debug information is shown to `sys.stderr`.
+        :param int prefetch: the number of chunks downloaded ahead by a background thread, see :func:`prefetch_files`.
+        :param cache: a :class:`ShardCache` to read the files from and to store them in.
+        :param dict skip: the numbers of lines to skip at the start of the files by the file names,
+            the lines are counted after filtering.
+        :param filters: the filters applied to the raw lines, see :func:`line_filter`.
+
+        :returns: a iterator over triples `(fname, url, batches)`
+
+    """
+    blocks = iter_raw_blocks(
+        ngram_len, lang=lang, indices=indices, chunk_size=chunk_size, verbose=verbose, prefetch=prefetch, cache=cache,
+        skip=skip, **filters
+    )
+
+    for fname, url, file_blocks in blocks:
+        yield fname, url, map(parse_batch, file_blocks)
+
+
+def iter_raw_blocks(
+    ngram_len, lang='eng', indices=None, chunk_size=1024 ** 2, verbose=False, prefetch=0, cache=None, skip=None,
+    **filters
+):
+    """Iterate over the decompressed data in the Google ngram collection without parsing it.
+
+    The parameters are the same as of :func:`iter_record_batches`.
+
+        :returns: a iterator over triples `(fname, url, blocks)`, see :func:`iter_line_blocks`.
+
+    """
+    accept = line_filter(**filters)
+
+    files = (
+        (fname, url, iter_response(request, chunk_size))
+        for fname, url, request in iter_google_store(
+            ngram_len, verbose=verbose, lang=lang, indices=indices, cache=cache,
+        )
+    )
+    if prefetch:
+        files = prefetch_files(files, prefetch)
+
+    for fname, url, chunks in files:
+        blocks = iter_line_blocks(chunks, url)
+
+        if accept is not None:
+            blocks = filter_lines(blocks, accept)
+
+        if skip and skip.get(fname):
+            blocks = skip_lines(blocks, skip[fname])
+
+        yield fname, url, blocks
+
+
+def iter_response(request, chunk_size):
+    """Iterate over the chunks of a response, the response is closed when the iteration stops."""
+    try:
+        for chunk in request.iter_content(chunk_size=chunk_size):
+            yield chunk
+    finally:
+        request.close()
+
+
+def skip_lines(blocks, n):
+    """Skip the first `n` lines of blocks of lines without parsing them.
+
+    :param iter blocks: blocks of lines as produced by :func:`iter_line_blocks`.
+
+    """
+    blocks = iter(blocks)
+
+    for block in blocks:
+        lines = block.count(b'\n') + 1
+        if lines <= n:
+            n -= lines
+            continue
+
+        end = -1
+        for _ in range(n):
+            end = block.index(b'\n', end + 1)
+
+        yield block[end + 1:]
+        break
+
+    for block in blocks:
+        yield block
+
+
+def prefetch_files(files, size):
+    """Read the chunks of the files in a background thread.
+
+    While the chunks are processed, the following chunks are downloaded, up
+    to `size` chunks ahead. The download of the next file starts as soon as
+    the previous file is downloaded. Once the next file is requested, the
+    download of the previous one stops and its chunks iterator is closed,
+    so a file that is skipped is not downloaded. Errors are raised in the
+    consuming thread.
+
+    :param iter files: triples `(fname, url, chunks)`.
+    :param int size: the number of chunks kept in memory.
+
+    :returns: an iterator over triples `(fname, url, chunks)`.
+
+    """
+    items = queue.Queue(size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def produce():
+        try:
+            for fname, url, chunks in files:
+                # Set by the consumer when it moves on to the next file.
+                skipped = threading.Event()
+                if not put((fname, url, skipped)):
+                    return
+
+                for chunk in chunks:
+                    if not put(chunk):
+                        return
+                    if skipped.is_set():
+                        break
+
+                close = getattr(chunks, 'close', None)
+                if close is not None:
+                    close()
+
+                if not put(_END_OF_FILE):
+                    return
+            put(None)
+        except BaseException as e:
+            put(_Failure(e))
+
+    def get():
+        item = items.get()
+        if isinstance(item, _Failure):
+            raise item.error
+        return item
+
+    def file_chunks():
+        while True:
+            chunk = get()
+            if chunk is _END_OF_FILE:
+                return
+            yield chunk
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item = get()
+            if item is None:
+                return
+
+            fname, url, skipped = item
+            chunks = file_chunks()
+            yield fname, url, chunks
+
+            # Only the chunks that are already read are left in the queue.
+            skipped.set()
+            for _ in chunks:
+                pass
+    finally:
+        stop.set()
+
+
+_END_OF_FILE = object()
+
+
+class _Failure(object):
+    """An exception passed from a background thread."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def iter_line_blocks(compressed_chunks, url):
+    """Decompress a gzip stream to blocks of complete lines.
+
+    :param iter compressed_chunks: the compressed data.
+    :param str url: the source of the data, used in error messages.
+
+    :returns: an iterator over byte strings of lines without the trailing newline.
+
+    """
+    dec = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    last = b''
+
+    waiting = time.perf_counter()
+    for compressed_chunk in compressed_chunks:
+        received = time.perf_counter()
+        data = dec.decompress(compressed_chunk)
+
+        if _stats_hooks:
+            inflated = time.perf_counter()
+            emit_stats('network', received - waiting, bytes_out=len(compressed_chunk))
+            emit_stats('inflate', inflated - received, bytes_in=len(compressed_chunk), bytes_out=len(data))
+
+        block = last + data
+        end = block.rfind(b'\n')
+        if end == -1:
+            last = block
+            waiting = time.perf_counter()
+            continue
+
+        block, last = block[:end], block[end + 1:]
+        yield block
+        waiting = time.perf_counter()
+
+    if last:
+        raise StreamInterruptionError(
+            url,
+            "Data stream ended on a non-empty line. This might be due "
+            "to temporary networking problems.")
+
+
+def line_filter(years=None, min_match_count=0, prefix=None, pattern=None, exclude_pos=False):
+    """Build a predicate over the raw lines of the collection files.
+
+    The lines are checked before they are decoded and parsed, the cheap
+    checks are done first.
+
+    :param years: a pair `(first, last)` of the years to keep, inclusive.
+    :param int min_match_count: the minimal match count of a line.
+    :param prefix: the prefix of the ngrams to keep.
+    :param pattern: a regular expression searched for in the ngrams.
+    :param bool exclude_pos: if `True`, the ngrams with part of speech tags are dropped.
+
+    :returns: a function that returns `True` for lines to keep, or `None` if there are no filters.
+
+    """
+    checks = []
+
+    if prefix:
+        prefix = prefix.encode('utf-8') if not isinstance(prefix, bytes) else prefix
+        checks.append(lambda line: line.startswith(prefix))
+
+    if pattern:
+        regex = re.compile(pattern.encode('utf-8') if not isinstance(pattern, bytes) else pattern)
+        checks.append(lambda line: regex.search(line, 0, line.find(b'\t')) is not None)
+
+    if exclude_pos:
+        checks.append(lambda line: POS_TAG.search(line, 0, line.find(b'\t')) is None)
+
+    if years is not None or min_match_count:
+        first_year, last_year = years if years is not None else (-float('inf'), float('inf'))
+
+        def check_numbers(line):
+            _, year, match_count, _ = line.rsplit(b'\t', 3)
+            return first_year <= int(year) <= last_year and int(match_count) >= min_match_count
+
+        checks.append(check_numbers)
+
+    if not checks:
+        return None
+
+    if len(checks) == 1:
+        return checks[0]
+
+    def accept(line):
+        for check in checks:
+            if not check(line):
+                return False
+        return True
+
+    return accept
+
+
+def filter_lines(blocks, accept):
+    """Keep the lines of the blocks for which `accept` returns `True`.
+
+    :param iter blocks: blocks of lines as produced by :func:`iter_line_blocks`.
+    :param accept: a predicate over lines, see :func:`line_filter`.
+
+    :returns: an iterator over non empty blocks of the accepted lines.
+
+    """
+    for block in blocks:
+        started = time.perf_counter()
+        filtered = b'\n'.join(filter(accept, block.split(b'\n')))
+
+        if _stats_hooks:
+            emit_stats('filter', time.perf_counter() - started, bytes_in=len(block), bytes_out=len(filtered))
+
+        if filtered:
+            yield filtered
+
+
+def parse_batch(block):
+    """Parse a block of lines to a :class:`RecordBatch`.
+
+    :param bytes block: newline separated lines without the trailing newline.
+
+    """
+    started = time.perf_counter()
+    fields = block.replace(b'\t', b'\n').split(b'\n')
+    assert len(fields) == 4 * (block.count(b'\n') + 1)
+    split = time.perf_counter()
+
+    ngrams = fields[0::4]
+    offsets = array('q', [0])
+    offsets.extend(accumulate(map(len, ngrams)))
+
+    del fields[0::4]
+    numbers = array('q', list(map(int, fields)))
+
+    if _stats_hooks:
+        emit_stats('split', split - started, bytes_in=len(block))
+        emit_stats('parse', time.perf_counter() - split, records=len(ngrams))
+
+    return RecordBatch(b''.join(ngrams), offsets, numbers[0::3], numbers[1::3], numbers[2::3])
+
+
+def iter_records(batch):
+    """Iterate over the records of a :class:`RecordBatch`."""
+    ngrams, offsets = batch.ngrams, batch.offsets
+
+    for start, end, year, match_count, volume_count in zip(
+        offsets, offsets[1:], batch.year, batch.match_count, batch.volume_count,
+    ):
+        yield Record(ngrams[start:end].decode('utf-8'), year, match_count, volume_count)
+
+
+def aggregate_records(records, year_window=None):
+    """Collapse the consecutive records of an ngram to a single record.
+
+    :param iter records: the records, the records of an ngram have to be consecutive.
+    :param int year_window: if given, the records are collapsed within
+        windows of this many years, for example 10 for decades.
+
+    :returns: an iterator over records with the summed counts. The year of a
+        record is the first year of the ngram or the first year of the window.
+
+    """
+    if year_window:
+        def key(r):
+            return r.ngram, r.year // year_window
+    else:
+        key = attrgetter('ngram')
+
+    for _, group in groupby(records, key=key):
+        ngram, year, match_count, volume_count = next(group)
+        for r in group:
+            match_count += r.match_count
+            volume_count += r.volume_count
+
+        if year_window:
+            year -= year % year_window
+
+        yield Record(ngram, year, match_count, volume_count)
+
+
+def ngram_to_cooc(ngram, count, index, known_words=None):
+    ngram = ngram.split()
+
+    middle_index = len(ngram) // 2
+    item = ngram[middle_index]
+    context = ngram[:middle_index] + ngram[middle_index + 1:]
+
+    if known_words is not None:
+        # The words out of the vocabulary are dropped before they get an id.
+        if item not in known_words:
+            return ()
+        context = [c for c in context if c in known_words]
+
+    item_id = word_to_id(item, index)
+    context_ids = (word_to_id(c, index) for c in context)
+
+    return tuple((p, count) for p in product([item_id], context_ids))
+
+
+def word_to_id(word, index):
+    try:
+        return index[word]
+    except KeyError:
+        id_ = len(index)
+        index[word] = id_
+        return id_
+
+
+class Vocabulary(collections.OrderedDict):
+    """An append-only word index stored in a text file.
+
+    The file contains a word per line, the id of a word is its line number
+    starting from 0. Use the vocabulary as the `index` of
+    :func:`count_coccurrence` to get ids that are the same across runs.
+
+    :param str path: the file, it's created by :meth:`save` if it doesn't exist.
+
+    """
+
+    def __init__(self, path):
+        super(Vocabulary, self).__init__()
+        self.path = path
+
+        if os.path.exists(path):
+            with io.open(path, encoding='utf-8') as f:
+                for word in f:
+                    self[word.rstrip(u'\n')] = len(self)
+
+        self._saved = len(self)
+
+    def save(self):
+        """Append the new words to the file."""
+        with io.open(self.path, 'a', encoding='utf-8') as f:
+            for word in islice(self, self._saved, None):
+                f.write(word + u'\n')
+
+        self._saved = len(self)
+
+
+def count_coccurrence(records, index, counter=None, known_words=None):
+    """Count the cooccurrence of the middle words of ngrams with the rest of the words.
+
+    :param iter records: the records, the records of an ngram have to be consecutive.
+    :param dict index: the word index, see :func:`word_to_id`.
+    :param counter: the counter to update, a new :class:`PairCounter` by default.
+    :param known_words: if given, only the pairs of these words are counted,
+        see :func:`frequent_words`.
+
+    :returns: the counter.
+
+    """
+    if counter is None:
+        counter = PairCounter()
+
+    if not _stats_hooks:
+        cooc = (ngram_to_cooc(r.ngram, r.match_count, index, known_words) for r in aggregate_records(records))
+        counter.add_pairs(chain.from_iterable(cooc))
+        return counter
+
+    # The records are produced lazily, the time spent reading them is
+    # subtracted to measure the counting alone.
+    records = _TimedIterator(records)
+    cooc = (ngram_to_cooc(r.ngram, r.match_count, index, known_words) for r in aggregate_records(records))
+
+    started = time.perf_counter()
+    counter.add_pairs(chain.from_iterable(cooc))
+    emit_stats('count', time.perf_counter() - started - records.seconds, records=records.count)
+
+    return counter
+
+
+def count_coccurrence_batches(batches, index, counter=None, known_words=None):
+    """Count the cooccurrence like :func:`count_coccurrence`, but in record batches.
+
+    The match counts of the consecutive records of an ngram are summed in
+    the columns of a batch, so an ngram is decoded once and no records are
+    created, see :func:`iter_ngram_counts`.
+
+    :param iter batches: the :class:`RecordBatch` objects.
+
+    :returns: the counter.
+
+    """
+    if counter is None:
+        counter = PairCounter()
+
+    if not _stats_hooks:
+        cooc = (
+            ngram_to_cooc(ngram, count, index, known_words)
+            for batch in batches
+            for ngram, count in iter_ngram_counts(batch)
+        )
+        counter.add_pairs(chain.from_iterable(cooc))
+        return counter
+
+    batches = _TimedIterator(batches)
+    records = [0]
+
+    def iter_counts():
+        for batch in batches:
+            records[0] += len(batch.year)
+            for ngram_count in iter_ngram_counts(batch):
+                yield ngram_count
+
+    started = time.perf_counter()
+    counter.add_pairs(chain.from_iterable(ngram_to_cooc(n, c, index, known_words) for n, c in iter_counts()))
+    emit_stats('count', time.perf_counter() - started - batches.seconds, records=records[0])
+
+    return counter
+
+
+def iter_ngram_counts(batch):
+    """Iterate over the `(ngram, match_count)` pairs of the ngrams in a batch.
+
+    The match counts of the consecutive records of an ngram are summed.
+
+    """
+    ngrams, offsets = batch.ngrams, batch.offsets
+    last, total = None, 0
+
+    for start, end, match_count in zip(offsets, offsets[1:], batch.match_count):
+        ngram = ngrams[start:end]
+        if ngram == last:
+            total += match_count
+        else:
+            if last is not None:
+                yield last.decode('utf-8'), total
+            last, total = ngram, match_count
+
+    if last is not None:
+        yield last.decode('utf-8'), total
+
+
+def slice_batch(batch, start, stop=None):
+    """Select the records from `start` to `stop` of a :class:`RecordBatch`."""
+    if stop is None:
+        stop = len(batch.year)
+
+    first = batch.offsets[start]
+    return RecordBatch(
+        batch.ngrams[first:batch.offsets[stop]],
+        array('q', (offset - first for offset in batch.offsets[start:stop + 1])),
+        batch.year[start:stop],
+        batch.match_count[start:stop],
+        batch.volume_count[start:stop],
+    )
+
+
+class BatchChunks(object):
+    """Split the record batches of a file to chunks.
+
+    A chunk ends after `records_in_file` records. If `memory_budget` is
+    given, it also ends after the records of the ngram during which the
+    counter of the chunk reached `memory_budget` bytes, see
+    :meth:`PairCounter.memory_usage`.
+
+    :param iter batches: the :class:`RecordBatch` objects of a file.
+    :param int records_in_file: the number of records in a chunk, no limit if `None`.
+    :param int memory_budget: the size of a counter in bytes.
+
+    """
+
+    def __init__(self, batches, records_in_file=None, memory_budget=None):
+        self.batches = iter(batches)
+        self.records_in_file = records_in_file
+        self.memory_budget = memory_budget
+
+        # The number of records in the last chunk.
+        self.records = 0
+        # The rest of a batch that was split between chunks.
+        self._pending = None
+
+    def _next_batch(self):
+        batch, self._pending = self._pending, None
+        if batch is None:
+            batch = next(self.batches, None)
+        return batch
+
+    def take(self, counter):
+        """Iterate over the batches of the next chunk.
+
+        :param counter: the counter the records are added to.
+
+        """
+        self.records = 0
+        records_in_file = self.records_in_file
+
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            size = len(batch.year)
+
+            if records_in_file and self.records + size >= records_in_file:
+                size = records_in_file - self.records
+                self.records += size
+                yield self._split(batch, size)
+                return
+
+            self.records += size
+            yield batch
+
+            if self.memory_budget and counter.memory_usage() >= self.memory_budget:
+                break
+
+        # The records of the last ngram may continue in the following batches.
+        offsets = batch.offsets
+        last = batch.ngrams[offsets[-2]:offsets[-1]]
+
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            ngrams, offsets = batch.ngrams, batch.offsets
+            size = len(batch.year)
+            i = 0
+            while i < size and ngrams[offsets[i]:offsets[i + 1]] == last:
+                i += 1
+
+            if records_in_file:
+                i = min(i, records_in_file - self.records)
+
+            self.records += i
+            if i < size:
+                if i:
+                    yield self._split(batch, i)
+                else:
+                    self._pending = batch
+                return
+
+            yield batch
+
+    def _split(self, batch, size):
+        """Keep the rest of a batch for the next chunk and return its first `size` records."""
+        if size < len(batch.year):
+            self._pending = slice_batch(batch, size)
+            return slice_batch(batch, 0, size)
+        return batch
+
+
+def frequent_words(lang='eng', vocab_size=None, min_count=0, indices=None, verbose=False, **kwargs):
+    """Rank the words by their total match count in the 1-grams.
+
+    :param str lang: the language of the words.
+    :param int vocab_size: the number of the most frequent words to keep, all by default.
+    :param int min_count: keep only the words with at least this total match count.
+    :param iter indices: the 1-gram files to read, all the files by default.
+    :param kwargs: the rest of the arguments of :func:`readline_google_store`.
+
+    :returns: a frozenset of the words.
+
+    """
+    counts = collections.Counter()
+    for _, _, records in readline_google_store(1, lang=lang, indices=indices, verbose=verbose, **kwargs):
+        for record in aggregate_records(records):
+            counts[record.ngram] += record.match_count
+
+    return frozenset(word for word, count in counts.most_common(vocab_size or None) if count >= min_count)
+
+
+class _TimedIterator(object):
+    """An iterator that measures the time spent in the underlying iterator."""
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            item = next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+        self.count += 1
+        return item
+
+    next = __next__
+
+
+class PairCounter(collections.Counter):
+    """A counter of `(item_id, context_id)` pairs."""
+
+    # A key tuple of two ids and a count.
+    pair_size = 56 + 3 * 28
+
+    def add_pairs(self, pairs):
+        """Add the counts of `((item_id, context_id), count)` pairs."""
+        for item, count in pairs:
+            self[item] += count
+
+    def memory_usage(self):
+        """The estimated size of the counter in bytes."""
+        return sys.getsizeof(self) + len(self) * self.pair_size
+
+
+class PackedCounter(Mapping):
+    """A compact counter of `(item_id, context_id)` pairs.
+
+    A pair is packed to a single 64 bit key `item_id << 32 | context_id`. The
+    counts are accumulated in a dictionary of at most `buffer_size` keys,
+    which is then sorted and reduced to a run of two arrays: the keys and the
+    counts. Runs of similar length are merged, so there are only
+    logarithmically many of them and a pair takes 16 bytes.
+
+    The pairs are iterated over in sorted order.
+
+    """
+
+    def __init__(self, buffer_size=2 ** 18):
+        self.buffer_size = buffer_size
+        self._buffer = {}
+        self._runs = []
+
+    def add_pairs(self, pairs):
+        """Add the counts of `((item_id, context_id), count)` pairs."""
+        buffer = self._buffer
+        buffer_size = self.buffer_size
+
+        for (item_id, context_id), count in pairs:
+            key = item_id << 32 | context_id
+            buffer[key] = buffer.get(key, 0) + count
+
+            if len(buffer) >= buffer_size:
+                self._flush()
+                buffer = self._buffer
+
+    def _flush(self):
+        if self._buffer:
+            keys = sorted(self._buffer)
+            self._runs.append((array('Q', keys), array('q', map(self._buffer.__getitem__, keys))))
+            self._buffer = {}
+
+        runs = self._runs
+        while len(runs) > 1 and len(runs[-2][0]) <= 2 * len(runs[-1][0]):
+            runs[-2:] = [merge_runs(*runs[-2:])]
+
+    def _merge_runs(self):
+        runs = self._runs
+        while len(runs) > 1:
+            runs[-2:] = [merge_runs(*runs[-2:])]
+
+    def memory_usage(self):
+        """The estimated size of the counts in memory in bytes."""
+        # A buffered key and count are integers of 28 bytes.
+        size = sys.getsizeof(self._buffer) + len(self._buffer) * 2 * 28
+        for keys, counts in self._runs:
+            size += len(keys) * keys.itemsize + len(counts) * counts.itemsize
+        return size
+
+    def compact(self):
+        """Reduce the counts to a single run."""
+        self._flush()
+        self._merge_runs()
+
+    def iter_packed(self):
+        """Iterate over the `(key, count)` pairs sorted by the key."""
+        self._flush()
+        if len(self._runs) == 1:
+            return zip(*self._runs[0])
+        return iter_merged_runs([zip(*run) for run in self._runs])
+
+    def items(self):
+        mask = 2 ** 32 - 1
+        return (((key >> 32, key & mask), count) for key, count in self.iter_packed())
+
+    def __iter__(self):
+        return (item for item, _ in self.items())
+
+    def __len__(self):
+        self.compact()
+        return len(self._runs[0][0]) if self._runs else 0
+
+    def __bool__(self):
+        return bool(self._buffer or self._runs)
+
+    def __getitem__(self, item):
+        item_id, context_id = item
+        key = item_id << 32 | context_id
+
+        found = key in self._buffer
+        count = self._buffer.get(key, 0)
+        for keys, counts in self._runs:
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                found = True
+                count += counts[i]
+
+        if not found:
+            raise KeyError(item)
+
+        return count
+
+
+class SpillingCounter(PackedCounter):
+    """A :class:`PackedCounter` that keeps at most about `max_pairs` pairs in memory.
+
+    When the limit is reached, the runs are merged and written to a temporary
+    file in `directory`. The files are merged with the runs in memory when the
+    counter is iterated over.
+
+    """
+
+    block_size = 2 ** 16
+
+    def __init__(self, max_pairs, directory=None, buffer_size=2 ** 18):
+        super(SpillingCounter, self).__init__(buffer_size=min(buffer_size, max_pairs))
+        self.max_pairs = max_pairs
+        self.directory = directory
+        self._spilled = []
+
+    def _flush(self):
+        super(SpillingCounter, self)._flush()
+
+        if sum(len(keys) for keys, _ in self._runs) >= self.max_pairs:
+            self._spill()
+
+    def _spill(self):
+        self._merge_runs()
+        keys, counts = self._runs.pop()
+
+        f = tempfile.TemporaryFile(dir=self.directory)
+        for start in range(0, len(keys), self.block_size):
+            keys[start:start + self.block_size].tofile(f)
+            counts[start:start + self.block_size].tofile(f)
+
+        self._spilled.append((f, len(keys)))
+
+    def _iter_spilled(self, f, size):
+        f.seek(0)
+        for start in range(0, size, self.block_size):
+            keys, counts = array('Q'), array('q')
+            keys.fromfile(f, min(self.block_size, size - start))
+            counts.fromfile(f, len(keys))
+
+            for key_count in zip(keys, counts):
+                yield key_count
+
+    def iter_packed(self):
+        self._flush()
+        runs = [self._iter_spilled(f, size) for f, size in self._spilled]
+        runs.extend(zip(*run) for run in self._runs)
+
+        return iter_merged_runs(runs)
+
+    def __len__(self):
+        return sum(1 for _ in self.iter_packed())
+
+    def __bool__(self):
+        return bool(self._spilled) or super(SpillingCounter, self).__bool__()
+
+    def __getitem__(self, item):
+        if not self._spilled:
+            return super(SpillingCounter, self).__getitem__(item)
+
+        for other, count in self.items():
+            if other == item:
+                return count
+        raise KeyError(item)
+
+
+def iter_merged_runs(runs):
+    """Merge sorted runs summing the counts of equal keys.
+
+    :param runs: a sequence of iterables over `(key, count)` pairs sorted by the key.
+
+    :returns: an iterator over `(key, count)` pairs sorted by the key.
+
+    """
+    last_key, last_count = None, 0
+
+    for key, count in heapq.merge(*runs):
+        if key == last_key:
+            last_count += count
+        else:
+            if last_key is not None:
+                yield last_key, last_count
+            last_key, last_count = key, count
+
+    if last_key is not None:
+        yield last_key, last_count
+
+
+def merge_runs(run, other):
+    """Merge two sorted runs of keys and counts summing the counts of equal keys."""
+    (keys_a, counts_a), (keys_b, counts_b) = run, other
+    keys, counts = array('Q'), array('q')
+    append_key, append_count = keys.append, counts.append
+
+    i = j = 0
+    len_a, len_b = len(keys_a), len(keys_b)
+    while i < len_a and j < len_b:
+        key_a, key_b = keys_a[i], keys_b[j]
+        if key_a < key_b:
+            append_key(key_a)
+            append_count(counts_a[i])
+            i += 1
+        elif key_b < key_a:
+            append_key(key_b)
+            append_count(counts_b[j])
+            j += 1
+        else:
+            append_key(key_a)
+            append_count(counts_a[i] + counts_b[j])
+            i += 1
+            j += 1
+
+    keys.extend(keys_a[i:])
+    counts.extend(counts_a[i:])
+    keys.extend(keys_b[j:])
+    counts.extend(counts_b[j:])
+
+    return keys, counts
+
+
+class SketchCounter(Mapping):
+    """An approximate counter of `(item_id, context_id)` pairs in fixed memory.
+
+    The counts of all the pairs are added to a count-min sketch of `depth`
+    rows of `width` counters, which takes `8 * width * depth` bytes. Only
+    the `top` pairs with the largest estimated counts are kept, they are the
+    items of the mapping.
+
+    An estimate is never smaller than the exact count and exceeds it by more
+    than :attr:`error_bound` with the probability of at most `exp(-depth)`,
+    see :meth:`bounds`. Use :meth:`estimate` to get the count of any pair.
+
+    """
+
+    _prime = 2 ** 61 - 1
+
+    def __init__(self, width=2 ** 22, depth=4, top=10 ** 6, seed=0):
+        self.width = width
+        self.depth = depth
+        self.top = top
+        self.total = 0
+
+        rng = random.Random(seed)
+        self._hashes = [(rng.randrange(1, self._prime), rng.randrange(self._prime)) for _ in range(depth)]
+        self._rows = [array('q', [0]) * width for _ in range(depth)]
+
+        # The candidates are pruned to the `top` largest when there are twice
+        # as many, the smallest kept count is the threshold for new pairs.
+        self._top = {}
+        self._threshold = 0
+
+    def add_pairs(self, pairs):
+        """Add the counts of `((item_id, context_id), count)` pairs."""
+        rows = list(zip(self._rows, self._hashes))
+        prime, width = self._prime, self.width
+        top = self._top
+
+        for (item_id, context_id), count in pairs:
+            key = item_id << 32 | context_id
+            self.total += count
+
+            estimate = None
+            for row, (a, b) in rows:
+                i = (a * key + b) % prime % width
+                value = row[i] + count
+                row[i] = value
+                if estimate is None or value < estimate:
+                    estimate = value
+
+            if key in top or estimate > self._threshold:
+                top[key] = estimate
+                if len(top) >= 2 * self.top:
+                    self._prune()
+                    top = self._top
+
+    def _prune(self):
+        kept = heapq.nlargest(self.top, self._top.items(), key=lambda item: item[1])
+        self._top = dict(kept)
+        self._threshold = kept[-1][1] if len(kept) == self.top else 0
+
+    def memory_usage(self):
+        """The estimated size of the sketch and the top pairs in bytes."""
+        return self.width * self.depth * 8 + sys.getsizeof(self._top) + len(self._top) * 2 * 28
+
+    def estimate(self, item):
+        """The estimated count of a pair, it doesn't have to be among the top pairs."""
+        item_id, context_id = item
+        key = item_id << 32 | context_id
+        return min(row[(a * key + b) % self._prime % self.width] for row, (a, b) in zip(self._rows, self._hashes))
+
+    @property
+    def error_bound(self):
+        """The overestimate of a count that is exceeded with the probability of at most `exp(-depth)`."""
+        return math.e / self.width * self.total
+
+    def bounds(self):
+        """The pair of :attr:`error_bound` and the probability that an estimate is within it."""
+        return self.error_bound, 1 - math.exp(-self.depth)
+
+    def items(self):
+        """The top pairs and their estimated counts, the largest counts first."""
+        if len(self._top) > self.top:
+            self._prune()
+
+        mask = 2 ** 32 - 1
+        return (
+            ((key >> 32, key & mask), count)
+            for key, count in sorted(self._top.items(), key=lambda item: (-item[1], item[0]))
+        )
+
+    def __iter__(self):
+        return (item for item, _ in self.items())
+
+    def __len__(self):
+        return min(len(self._top), self.top)
+
+    def __bool__(self):
+        return bool(self._top)
+
+    def __getitem__(self, item):
+        item_id, context_id = item
+        key = item_id << 32 | context_id
+
+        if len(self._top) > self.top:
+            self._prune()
+
+        if key not in self._top:
+            raise KeyError(item)
+        return self._top[key]
+
+
+class GzipWriter(object):
+    """Write a gzip file compressing blocks of data in parallel.
+
+    The written data is collected to blocks of `block_size` bytes, which are
+    compressed to separate gzip members by a pool of threads and written in
+    order. A concatenation of gzip members is a valid gzip file.
+
+    :param str path: the output file.
+    :param int level: the compression level from 1 (fast) to 9 (small).
+    :param int block_size: the size of uncompressed blocks.
+    :param int threads: the number of compressing threads.
+    :param fileobj: a binary file to write to instead of `path`, it is not closed.
+
+    """
+
+    def __init__(self, path=None, level=6, block_size=2 ** 24, threads=4, fileobj=None):
+        self.level = level
+        self.block_size = block_size
+        self.max_pending = 2 * threads
+
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+
+        self.pending = collections.deque()
+        self.pool = ThreadPool(threads)
+
+        self.close_file = fileobj is None
+        self.f = open(path, 'wb') if fileobj is None else fileobj
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
+            if self.close_file:
+                self.f.close()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+
+        if self.buffered >= self.block_size:
+            self._compress()
+
+    def _compress(self):
+        block = b''.join(self.buffer)
+        self.buffer, self.buffered = [], 0
+
+        self.pending.append(self.pool.apply_async(gzip.compress, (block, self.level)))
+
+        # The compressed blocks wait in memory until the preceding ones are written.
+        while len(self.pending) > self.max_pending:
+            self._write_member()
+
+    def _write_member(self):
+        member = self.pending.popleft().get()
+        self.f.write(member)
+        self.written += len(member)
+
+    def close(self):
+        """Compress and write the rest of the data."""
+        if self.buffer or not self.written and not self.pending:
+            # An empty file still gets a gzip header.
+            self._compress()
 
+        while self.pending:
+            self._write_member()
 
-def readline_google_store(ngram_len, lang='eng', indices=None, chunk_size=1024 ** 2, verbose=False):
-    """Iterate over the data in the Google ngram collectioin.
+        self.pool.terminate()
+        if self.close_file:
+            self.f.close()
 
-        :param int ngram_len: the length of ngrams to be streamed.
-        :param str lang: the langueage of the ngrams.
-        :param iter indices: the file indices to be downloaded.
-        :param int chunk_size: the size the chunks of raw compressed data.
-        :param bool verbose: if `True`, then the debug information is shown to `sys.stderr`.
 
-        :returns: a iterator over triples `(fname, url, records)`
+def write_cooccurrence_binary(path, items, sort=False):
+    """Write cooccurrence counts in a binary format.
 
-    """
+    The file starts with a header of :data:`BINARY_HEADER` followed by three
+    little endian columns: the uint32 item ids, the uint32 context ids and
+    the int64 counts. The `i`-th pair is stored at the `i`-th position of
+    every column, so a column can be mapped to memory without copying, see
+    :func:`read_cooccurrence_binary`.
 
-    for fname, url, request in iter_google_store(ngram_len, verbose=verbose, lang=lang, indices=indices):
-        dec = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    :param str path: the output file.
+    :param iter items: the `((item_id, context_id), count)` pairs.
+    :param bool sort: if `True`, the pairs are sorted by the ids.
 
-        def lines():
-            last = b''
-            compressed_chunks = request.iter_content(chunk_size=chunk_size)
+    :returns: the number of the written pairs.
 
-            for i, compressed_chunk in enumerate(compressed_chunks):
-                chunk = dec.decompress(compressed_chunk)
+    """
+    if sort:
+        items = sorted(items)
 
-                lines = (last + chunk).split(b'\n')
-                lines, last = lines[:-1], lines[-1]
+    item_ids, context_ids, counts = array('I'), array('I'), array('q')
+    is_sorted, last = True, (-1, -1)
+    for pair, count in items:
+        if pair < last:
+            is_sorted = False
+        last = pair
 
-                for line in lines:
-                    line = line.decode('utf-8')
-                    data = line.split('\t')
-                    assert len(data) == 4
-                    ngram = data[0]
-                    other = map(int, data[1:])
-                    yield Record(ngram, *other)
+        item_ids.append(pair[0])
+        context_ids.append(pair[1])
+        counts.append(count)
 
-            if last:
-                raise StreamInterruptionError(
-                    url,
-                    "Data stream ended on a non-empty line. This might be due "
-                    "to temporary networking problems.")
+    if sys.byteorder == 'big':
+        for column in item_ids, context_ids, counts:
+            column.byteswap()
 
-        yield fname, url, lines()
+    with open(path, 'wb') as f:
+        f.write(struct.pack(BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION, int(is_sorted), len(counts)))
+        for column in item_ids, context_ids, counts:
+            column.tofile(f)
 
+    return len(counts)
 
-def ngram_to_cooc(ngram, count, index):
-    ngram = ngram.split()
 
-    middle_index = len(ngram) // 2
-    item = ngram[middle_index]
-    context = ngram[:middle_index] + ngram[middle_index + 1:]
+def read_cooccurrence_binary(path):
+    """Read a file written by :func:`write_cooccurrence_binary`.
 
-    item_id = word_to_id(item, index)
-    context_ids = (word_to_id(c, index) for c in context)
+    The file is memory mapped and the columns are exposed as memoryviews over
+    the mapping, `numpy.frombuffer()` turns them to arrays without copying.
 
-    return tuple((p, count) for p in product([item_id], context_ids))
+    :returns: a :class:`CooccurrenceMatrix`.
 
+    """
+    with open(path, 'rb') as f:
+        magic, version, flags, size = struct.unpack(BINARY_HEADER, f.read(struct.calcsize(BINARY_HEADER)))
+        assert magic == BINARY_MAGIC and version == BINARY_VERSION, '{} is not a cooccurrence file.'.format(path)
 
-def word_to_id(word, index):
-    try:
-        return index[word]
-    except KeyError:
-        id_ = len(index)
-        index[word] = id_
-        return id_
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
 
+    offset = struct.calcsize(BINARY_HEADER)
+    columns = []
+    for typecode in 'I', 'I', 'q':
+        width = array(typecode).itemsize
+        column = data[offset:offset + width * size].cast(typecode)
+        offset += width * size
 
-def count_coccurrence(records, index):
-    grouped_records = groupby(records, key=lambda r: r.ngram)
-    ngram_counts = ((ngram, sum(r.match_count for r in records)) for ngram, records in grouped_records)
-    cooc = (ngram_to_cooc(ngram, count, index) for ngram, count in ngram_counts)
+        if sys.byteorder == 'big':
+            column = array(typecode, column)
+            column.byteswap()
 
-    counter = collections.Counter()
-    for item, count in chain.from_iterable(cooc):
-        counter[item] += count
+        columns.append(column)
 
-    return counter
+    return CooccurrenceMatrix(*columns, sorted=bool(flags & 1))
 
 
-def iter_google_store(ngram_len, lang="eng", indices=None, verbose=False):
+def iter_google_store(ngram_len, lang="eng", indices=None, verbose=False, cache=None):
     """Iterate over the collection files stored at Google.
 
     :param int ngram_len: the length of ngrams to be streamed.
     :param str lang: the langueage of the ngrams.
     :param iter indices: the file indices to be downloaded.
     :param bool verbose: if `True`, then the debug information is shown to `sys.stderr`.
+    :param cache: a :class:`ShardCache` to read the files from and to store them in.
+
+    """
+    session = make_session()
+
+    for fname, url in google_store_urls(ngram_len, lang=lang, indices=indices):
+        if verbose:
+            sys.stderr.write(
+                'Downloading {url} '
+                ''.format(
+                    url=url,
+                ),
+            )
+            sys.stderr.flush()
+
+        if cache is not None:
+            request = cache.open(session, fname, url)
+        else:
+            request = session.get(url, stream=True)
+            assert request.status_code == 200
+
+        yield fname, url, request
+
+        if verbose:
+            sys.stderr.write('\n')
+
+
+class ShardCache(object):
+    """A local cache of the collection files.
+
+    A file is read from the cache folder if its size and its ETag match the
+    ones reported by the server, or if the server can't be reached.
+    Otherwise the file is downloaded and written to the cache while it's
+    read. A file is added to the cache only if it's read to the end.
+
+    Once the files take more than `max_size` bytes, the least recently used
+    ones are removed. The folder of the download command can be used as a
+    cache, but then `max_size` should not be set.
+
+    :param str directory: the cache folder.
+    :param int max_size: the disk budget in bytes, `None` for no limit.
+    :param bool validate: if `False`, the cached files are used without asking the server.
+
+    """
+
+    def __init__(self, directory, max_size=None, validate=True):
+        self.directory = directory
+        self.max_size = max_size
+        self.validate = validate
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open(self, session, fname, url):
+        """Open a file.
+
+        :returns: an object with the `iter_content(chunk_size)` method of a response.
+
+        """
+        path = os.path.join(self.directory, fname)
+
+        if os.path.exists(path) and self.is_valid(session, url, path):
+            # The access time orders the files for eviction.
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+            return _CachedFile(path)
+
+        request = session.get(url, stream=True)
+        request.raise_for_status()
+
+        return _CachingResponse(self, request, path, url)
+
+    def is_valid(self, session, url, path):
+        """Check whether a cached file is the same as the one on the server."""
+        meta = self.read_meta(path)
+        size = os.path.getsize(path)
+
+        if self.validate:
+            try:
+                head = session.head(url, allow_redirects=True)
+                head.raise_for_status()
+            except requests.RequestException:
+                pass
+            else:
+                remote_size = head.headers.get('Content-Length')
+                etag = head.headers.get('ETag')
+
+                if remote_size is not None and int(remote_size) != size:
+                    return False
+                return not (etag and meta and meta.get('etag') and meta['etag'] != etag)
+
+        # A file that was not written by the cache has no metadata and is assumed to be complete.
+        return meta is None or meta['size'] == size
+
+    def read_meta(self, path):
+        if not os.path.exists(path + '.meta'):
+            return None
+        with open(path + '.meta') as f:
+            return json.load(f)
+
+    def add(self, path, url, size, etag):
+        """Add a complete file, the data is already written to `path + '.part'`."""
+        os.rename(path + '.part', path)
+        with open(path + '.meta', 'w') as f:
+            json.dump({'url': url, 'size': size, 'etag': etag}, f)
+
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """Remove the least recently used files until the files fit the disk budget."""
+        if not self.max_size:
+            return
+
+        # Worker processes share the cache, a file may be removed by another
+        # process at any moment.
+        files = []
+        for fname in os.listdir(self.directory):
+            if fname.startswith('googlebooks-') and fname.endswith('.gz'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, fname))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_atime, os.path.join(self.directory, fname), stat.st_size))
+
+        total = sum(size for _, _, size in files)
+        for _, path, size in sorted(files):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+
+            for removed in path, path + '.meta':
+                try:
+                    os.remove(removed)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
+class _CachedFile(object):
+    """A cached file that is read like a response."""
+
+    status_code = 200
+
+    def __init__(self, path):
+        self.path = path
+        self.headers = {'Content-Length': str(os.path.getsize(path))}
+
+    def close(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+
+class _CachingResponse(object):
+    """A response that writes the data to the cache while it's read."""
+
+    def __init__(self, cache, request, path, url):
+        self.cache = cache
+        self.request = request
+        self.path = path
+        self.url = url
+
+        self.status_code = request.status_code
+        self.headers = request.headers
+
+    def close(self):
+        self.request.close()
+
+    def iter_content(self, chunk_size):
+        part = self.path + '.part'
+        size = 0
+        complete = False
+
+        try:
+            with open(part, 'wb') as f:
+                for chunk in self.request.iter_content(chunk_size):
+                    f.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+
+            expected_size = self.headers.get('Content-Length')
+            complete = expected_size is None or int(expected_size) == size
+        finally:
+            if complete:
+                self.cache.add(self.path, self.url, size, self.headers.get('ETag'))
+            elif os.path.exists(part):
+                os.remove(part)
+
+
+def google_store_urls(ngram_len, lang='eng', indices=None):
+    """Iterate over the names and the urls of the collection files.
+
+    :param int ngram_len: the length of ngrams.
+    :param str lang: the langueage of the ngrams.
+    :param iter indices: the file indices, all the indices by default.
+
+    :returns: an iterator over pairs `(fname, url)`
 
     """
     version = '20120701'
-    session = requests.Session()
 
     indices = get_indices(ngram_len) if indices is None else indices
 
@@ -123,24 +1528,566 @@ def iter_google_store(ngram_len, lang="eng", indices=None, verbose=False):
             index=index,
         )
 
-        url = URL_TEMPLATE.format(fname)
+        yield fname, URL_TEMPLATE.format(fname)
 
-        if verbose:
-            sys.stderr.write(
-                'Downloading {url} '
+
+def google_store_manifest(ngram_len, lang='eng', indices=None, jobs=1):
+    """Collect the sizes and the ETags of the collection files.
+
+    :param int ngram_len: the length of ngrams.
+    :param str lang: the langueage of the ngrams.
+    :param iter indices: the file indices, all the indices by default.
+    :param int jobs: the number of HEAD requests issued in parallel.
+
+    :returns: a list of dictionaries with the `index`, `fname`, `url`,
+        `size` and `etag` keys in the order of the indices. The size is
+        `None` if the server does not report it.
+
+    """
+    session = make_session(jobs)
+    indices = list(get_indices(ngram_len) if indices is None else indices)
+
+    def head(index_fname_url):
+        index, (fname, url) = index_fname_url
+        started = time.perf_counter()
+        response = session.head(url, allow_redirects=True)
+        response.raise_for_status()
+
+        if _stats_hooks:
+            emit_stats('head', time.perf_counter() - started)
+
+        size = response.headers.get('Content-Length')
+        return {
+            'index': index,
+            'fname': fname,
+            'url': url,
+            'size': int(size) if size is not None else None,
+            'etag': response.headers.get('ETag'),
+        }
+
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(head, list(zip(indices, google_store_urls(ngram_len, lang=lang, indices=indices))))
+    finally:
+        pool.terminate()
+
+
+def partition_indices(sizes, num_workers):
+    """Assign files to workers so that every worker gets about the same amount of data.
+
+    The largest files are assigned first, each to the worker with the least
+    data so far. The assignment depends only on the sizes, so every worker
+    computes the same one.
+
+    :param sizes: pairs `(index, size)`, the size is `None` if it's unknown,
+        then the mean size is assumed.
+    :param int num_workers: the number of workers.
+
+    :returns: a list of `num_workers` lists of indices in the given order.
+
+    """
+    known = [size for _, size in sizes if size is not None]
+    default = sum(known) / len(known) if known else 1
+    sizes = [(index, default if size is None else size) for index, size in sizes]
+
+    loads = [(0, worker) for worker in range(num_workers)]
+    assigned = [[] for _ in range(num_workers)]
+
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], i)):
+        load, worker = heapq.heappop(loads)
+        assigned[worker].append(i)
+        heapq.heappush(loads, (load + sizes[i][1], worker))
+
+    return [[sizes[i][0] for i in sorted(worker_files)] for worker_files in assigned]
+
+
+def make_session(pool_size=1):
+    """Create a session with a connection pool for `pool_size` threads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def download_google_store(
+    ngram_len, output_dir, lang='eng', indices=None, jobs=1, retries=3, chunk_size=1024 ** 2, rewrite=False,
+    sizes=None, progress=None, segments=1,
+):
+    """Download the collection files to a local folder.
+
+    With `jobs` greater than one the files are fetched by a pool of threads
+    that share the connection pool of a single session. Complete files are
+    skipped and interrupted downloads are resumed, see :func:`download_file`.
+
+    :param int ngram_len: the length of ngrams to be downloaded.
+    :param str output_dir: the destination folder.
+    :param str lang: the langueage of the ngrams.
+    :param iter indices: the file indices to be downloaded.
+    :param int jobs: the number of files downloaded in parallel.
+    :param int retries: the number of times a failed download is retried.
+    :param int chunk_size: the size of the chunks written to disk.
+    :param bool rewrite: if `True`, existing files are downloaded from scratch.
+    :param dict sizes: the known file sizes by url, see :func:`google_store_manifest`.
+    :param progress: a :class:`Progress` instance to report to.
+    :param int segments: the number of connections a file is downloaded over, see :func:`download_file_segmented`.
+
+    :returns: an iterator over pairs `(fname, url)` in the order the downloads complete.
+
+    """
+    session = make_session(jobs * segments)
+    sizes = sizes or {}
+
+    def fetch(fname_url):
+        fname, url = fname_url
+        path = os.path.join(str(output_dir), fname)
+        options = dict(
+            retries=retries, chunk_size=chunk_size, rewrite=rewrite, remote_size=sizes.get(url), progress=progress,
+        )
+
+        if segments > 1:
+            download_file_segmented(session, url, path, segments=segments, **options)
+        else:
+            download_file(session, url, path, **options)
+        return fname, url
+
+    urls = google_store_urls(ngram_len, lang=lang, indices=indices)
+
+    if jobs == 1:
+        for fname_url in urls:
+            yield fetch(fname_url)
+        return
+
+    pool = ThreadPool(jobs)
+    try:
+        for fname_url in pool.imap_unordered(fetch, urls):
+            yield fname_url
+    finally:
+        pool.terminate()
+
+
+def download_file(
+    session, url, path, retries=3, chunk_size=1024 ** 2, delay=1, rewrite=False, remote_size=None, progress=None,
+):
+    """Download a file, retrying on networking errors.
+
+    The data is written to `path + '.part'`, which is renamed to `path` once
+    the download is complete, so `path` never refers to a truncated file. An
+    existing `path` is kept if its size matches the Content-Length reported
+    by the server and a `.part` file left by an interrupted download is
+    continued with a Range request.
+
+    :param session: a :class:`requests.Session` instance.
+    :param str url: the url of the file.
+    :param str path: the destination file.
+    :param int retries: the number of times a failed download is retried.
+    :param int chunk_size: the size of the chunks written to disk.
+    :param delay: the number of seconds to wait before the first retry, it is doubled after every attempt.
+    :param bool rewrite: if `True`, existing files are downloaded from scratch.
+    :param int remote_size: the size of the file, if it's known there is no need in a HEAD request.
+    :param progress: a :class:`Progress` instance to report to.
+
+    :returns: `False` if the file was already downloaded, `True` otherwise.
+
+    """
+    part = path + '.part'
+    started = False
+
+    if rewrite:
+        for p in path, part:
+            if os.path.exists(p):
+                os.remove(p)
+
+    for attempt in range(retries + 1):
+        try:
+            if os.path.exists(path):
+                if remote_size is None:
+                    head = session.head(url, allow_redirects=True)
+                    head.raise_for_status()
+                    remote_size = int(head.headers.get('Content-Length', -1))
+
+                if remote_size == os.path.getsize(path):
+                    if progress is not None:
+                        progress.skip(url, remote_size)
+                    return False
+
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+            request = session.get(url, stream=True, headers=headers)
+
+            if request.status_code == 416:
+                # The partial file is not a prefix of the remote file.
+                os.remove(part)
+                raise StreamInterruptionError(url, 'The download could not be resumed.')
+
+            request.raise_for_status()
+
+            if request.status_code != 206:
+                # The server ignored the Range header.
+                offset = 0
+
+            expected_size = request.headers.get('Content-Length')
+            if expected_size is not None:
+                expected_size = offset + int(expected_size)
+
+            if progress is not None and not started:
+                progress.start(url, expected_size or remote_size, offset)
+                started = True
+
+            size = offset
+            transfer_started = time.perf_counter()
+            with open(part, 'ab' if offset else 'wb') as f:
+                for chunk in request.iter_content(chunk_size):
+                    f.write(chunk)
+                    size += len(chunk)
+
+                    if progress is not None:
+                        progress.update(url, len(chunk))
+
+            if expected_size is not None and expected_size != size:
+                raise StreamInterruptionError(
+                    url,
+                    'Expected {} bytes, but got {}.'.format(expected_size, size),
+                )
+
+        except (requests.RequestException, StreamInterruptionError):
+            if attempt == retries:
+                raise
+            time.sleep(delay * 2 ** attempt)
+
+        else:
+            os.rename(part, path)
+
+            if _stats_hooks:
+                emit_stats('download', time.perf_counter() - transfer_started, bytes_out=size - offset)
+
+            if progress is not None:
+                progress.finish(url)
+            return True
+
+
+def download_file_segmented(
+    session, url, path, segments=4, retries=3, chunk_size=1024 ** 2, delay=1, rewrite=False, remote_size=None,
+    progress=None,
+):
+    """Download a file over several connections at once.
+
+    The file is split to `segments` byte ranges, which are fetched by
+    separate threads and written at their offsets to a preallocated
+    `path + '.part'` file. Every range is retried on its own. The progress of
+    the ranges is saved to `path + '.part.json'` if the download fails, so
+    the next attempt continues it. Files smaller than `segments` chunks are
+    split to fewer ranges.
+
+    The server has to support range requests. If the size of the file is
+    unknown, it's downloaded with :func:`download_file`.
+
+    The rest of the parameters and the return value are the same as of
+    :func:`download_file`.
+
+    """
+    part, state_path = path + '.part', path + '.part.json'
+
+    if rewrite:
+        for p in path, part, state_path:
+            if os.path.exists(p):
+                os.remove(p)
+
+    if remote_size is None:
+        head = session.head(url, allow_redirects=True)
+        head.raise_for_status()
+        remote_size = int(head.headers.get('Content-Length', -1))
+
+    if remote_size < 0:
+        return download_file(
+            session, url, path, retries=retries, chunk_size=chunk_size, delay=delay, progress=progress,
+        )
+
+    if os.path.exists(path) and os.path.getsize(path) == remote_size:
+        if progress is not None:
+            progress.skip(url, remote_size)
+        return False
+
+    # Every range is a list of the start offset, the end offset and the number of downloaded bytes.
+    ranges = None
+    if os.path.exists(part) and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        if state['size'] == remote_size and os.path.getsize(part) == remote_size:
+            ranges = state['ranges']
+
+    if ranges is None:
+        segments = max(1, min(segments, remote_size // chunk_size))
+        bounds = [remote_size * i // segments for i in range(segments + 1)]
+        ranges = [[start, end, 0] for start, end in zip(bounds, bounds[1:])]
+
+        with open(part, 'wb') as f:
+            f.truncate(remote_size)
+
+    offset = sum(done for _, _, done in ranges)
+    if progress is not None:
+        progress.start(url, remote_size, offset)
+
+    def fetch(segment):
+        start, end, _ = segment
+
+        for attempt in range(retries + 1):
+            try:
+                if start + segment[2] == end:
+                    return
+
+                request = session.get(
+                    url, stream=True, headers={'Range': 'bytes={}-{}'.format(start + segment[2], end - 1)},
+                )
+                request.raise_for_status()
+
+                if request.status_code != 206:
+                    raise StreamInterruptionError(url, 'The server does not support range requests.')
+
+                with open(part, 'r+b') as f:
+                    f.seek(start + segment[2])
+                    for chunk in request.iter_content(chunk_size):
+                        chunk = chunk[:end - start - segment[2]]
+                        f.write(chunk)
+                        segment[2] += len(chunk)
+
+                        if progress is not None:
+                            progress.update(url, len(chunk))
+
+                if start + segment[2] != end:
+                    raise StreamInterruptionError(
+                        url,
+                        'Expected {} bytes, but got {}.'.format(end - start, segment[2]),
+                    )
+
+            except (requests.RequestException, StreamInterruptionError):
+                if attempt == retries:
+                    raise
+                time.sleep(delay * 2 ** attempt)
+
+    started = time.perf_counter()
+    pool = ThreadPool(len(ranges))
+    try:
+        pool.map(fetch, ranges)
+    except BaseException:
+        with open(state_path, 'w') as f:
+            json.dump({'size': remote_size, 'ranges': ranges}, f)
+        raise
+    finally:
+        pool.terminate()
+
+    os.rename(part, path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    if _stats_hooks:
+        emit_stats('download', time.perf_counter() - started, bytes_out=remote_size - offset)
+
+    if progress is not None:
+        progress.finish(url)
+    return True
+
+
+class Progress(object):
+    """Track the progress of downloads and report the rates and the estimated time left.
+
+    Human readable reports are written to `stream`, the status line is
+    updated in place and there is a line for every finished file. The same
+    information is written to `log` as JSON lines. The methods can be called
+    from several threads.
+
+    :param int total_size: the size of all the files, if known.
+    :param stream: a text stream for the human readable reports, e.g. `sys.stderr`.
+    :param log: a text stream for the JSON lines.
+    :param float interval: the minimal number of seconds between the reports of the progress.
+
+    """
+
+    def __init__(self, total_size=None, stream=None, log=None, interval=1.0):
+        self.total_size = total_size
+        self.stream = stream
+        self.log = log
+        self.interval = interval
+
+        self.started = time.time()
+        self.done = 0
+        self.fetched = 0
+
+        self._files = {}
+        self._last_report = 0
+        self._lock = threading.Lock()
+
+    def start(self, url, size, offset=0):
+        """Register a download of `url` that continues from `offset`."""
+        with self._lock:
+            self._files[url] = {'size': size, 'done': offset, 'fetched': 0, 'started': time.time()}
+            self.done += offset
+
+    def update(self, url, nbytes):
+        """Register that `nbytes` more bytes of `url` were downloaded."""
+        with self._lock:
+            state = self._files[url]
+            state['done'] += nbytes
+            state['fetched'] += nbytes
+            self.done += nbytes
+            self.fetched += nbytes
+
+            now = time.time()
+            if now - self._last_report >= self.interval:
+                self._last_report = now
+                self._report('progress', url, now)
+
+    def finish(self, url):
+        """Register that the download of `url` is complete."""
+        with self._lock:
+            self._report('done', url, time.time())
+            del self._files[url]
+
+    def skip(self, url, size):
+        """Register that `url` of `size` bytes was downloaded before."""
+        self.start(url, size, offset=size)
+        with self._lock:
+            self._report('skipped', url, time.time())
+            del self._files[url]
+
+    def _report(self, event, url, now):
+        state = self._files[url]
+
+        rate = state['fetched'] / max(now - state['started'], 1e-6)
+        total_rate = self.fetched / max(now - self.started, 1e-6)
+
+        report = {
+            'event': event,
+            'url': url,
+            'time': now,
+            'bytes': state['done'],
+            'size': state['size'],
+            'rate': rate,
+            'eta': eta(state['done'], state['size'], rate),
+            'total_bytes': self.done,
+            'total_size': self.total_size,
+            'total_rate': total_rate,
+            'total_eta': eta(self.done, self.total_size, total_rate),
+        }
+
+        if self.log is not None:
+            self.log.write(json.dumps(report) + '\n')
+            self.log.flush()
+
+        if self.stream is not None:
+            line = (
+                '{name} {event}: {bytes} of {size} at {rate}/s, ETA {eta}. '
+                'Total: {total_bytes} of {total_size} at {total_rate}/s, ETA {total_eta}.'
                 ''.format(
-                    url=url,
-                ),
+                    name=url.rsplit('/', 1)[-1],
+                    event=event,
+                    bytes=format_size(report['bytes']),
+                    size=format_size(report['size']),
+                    rate=format_size(rate),
+                    eta=format_seconds(report['eta']),
+                    total_bytes=format_size(self.done),
+                    total_size=format_size(self.total_size),
+                    total_rate=format_size(total_rate),
+                    total_eta=format_seconds(report['total_eta']),
+                )
             )
-            sys.stderr.flush()
+            self.stream.write('\r' + line + ('\n' if event != 'progress' else ''))
+            self.stream.flush()
 
-        request = session.get(url, stream=True)
-        assert request.status_code == 200
 
-        yield fname, url, request
+def eta(done, size, rate):
+    """Estimate the number of seconds left, `None` if it's unknown."""
+    if size is None or not rate:
+        return None
+    return max(size - done, 0) / rate
+
+
+def format_size(size):
+    if size is None:
+        return '?'
+    return '{:.1f} MB'.format(size / 1024 ** 2)
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
 
-        if verbose:
-            sys.stderr.write('\n')
+
+class Stats(object):
+    """Accumulate the measurements of the pipeline stages.
+
+    An instance is a stats hook, it registers itself when used as a context manager::
+
+        with Stats() as stats:
+            for _, _, records in readline_google_store(2, indices=['aa']):
+                ...
+
+        sys.stderr.write(stats.summary())
+
+    """
+
+    STAGES = 'head', 'download', 'network', 'inflate', 'filter', 'split', 'parse', 'count', 'write', 'index', 'lookup'
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __call__(self, stage, seconds, bytes_in=0, bytes_out=0, records=0):
+        self.update({
+            stage: {'calls': 1, 'seconds': seconds, 'bytes_in': bytes_in, 'bytes_out': bytes_out, 'records': records},
+        })
+
+    def __enter__(self):
+        add_stats_hook(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove_stats_hook(self)
+
+    def as_dict(self):
+        """The totals of the stages as a dictionary of the stage names to dictionaries."""
+        with self.lock:
+            return dict((stage, dict(totals)) for stage, totals in self.stages.items())
+
+    def update(self, stages):
+        """Add the totals in the format of :meth:`as_dict`, for example collected by another process."""
+        with self.lock:
+            for stage, totals in stages.items():
+                current = self.stages.setdefault(stage, dict.fromkeys(totals, 0))
+                for key, value in totals.items():
+                    current[key] += value
+
+    def summary(self):
+        """Format the totals as a table, one stage per line."""
+        stages = self.as_dict()
+        order = [stage for stage in self.STAGES if stage in stages]
+        order.extend(sorted(set(stages).difference(order)))
+
+        lines = [
+            u'{:<10}{:>10}{:>12}{:>12}{:>12}{:>14}{:>12}\n'.format(
+                'stage', 'calls', 'seconds', 'MB in', 'MB out', 'records', 'MB/s',
+            )
+        ]
+        for stage in order:
+            totals = stages[stage]
+            nbytes = totals['bytes_in'] or totals['bytes_out']
+            rate = nbytes / 1024 ** 2 / totals['seconds'] if nbytes and totals['seconds'] else None
+            lines.append(
+                u'{stage:<10}{calls:>10}{seconds:>12.3f}{mb_in:>12.1f}{mb_out:>12.1f}{records:>14}{rate:>12}\n'.format(
+                    stage=stage,
+                    mb_in=totals['bytes_in'] / 1024 ** 2,
+                    mb_out=totals['bytes_out'] / 1024 ** 2,
+                    rate='' if rate is None else '{:.1f}'.format(rate),
+                    **totals
+                )
+            )
+
+        return u''.join(lines)
 
 
 def get_indices(ngram_len):
@@ -216,3 +2163,40 @@ def get_indices(ngram_len):
         )
 
     return chain(digits, letter_indices, other_indices)
+
+
+# The part of speech tags that have their own files.
+POS_INDICES = frozenset(('_ADJ_', '_ADP_', '_ADV_', '_CONJ_', '_DET_', '_NOUN_', '_NUM_', '_PRON_', '_PRT_', '_VERB_'))
+
+
+def ngram_index(ngram, ngram_len):
+    """Find the index of the file that contains an ngram, see :func:`get_indices`.
+
+    The files are split by the first one or two characters of an ngram,
+    ignoring the case. If the second character is not a letter the index
+    ends with an underscore, for example, `a_` for "a dog". Part of speech
+    tags, punctuation and the rest of the characters go to their own files.
+
+    """
+    first_word = ngram.split(' ', 1)[0]
+
+    if first_word in POS_INDICES:
+        return 'pos' if ngram_len == 1 else first_word
+
+    first, second = first_word[:1].lower(), first_word[1:2].lower()
+
+    if not first:
+        return 'other'
+
+    if first in digits:
+        return first
+
+    if first in ascii_lowercase:
+        if ngram_len == 1:
+            return first
+        return first + (second if second and second in ascii_lowercase else '_')
+
+    if first in punctuation:
+        return 'punctuation'
+
+    return 'other'
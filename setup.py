@@ -51,11 +51,12 @@ setup(
         'Topic :: Utilities',
         'Topic :: Text Processing :: Linguistic',
         'Topic :: Scientific/Engineering :: Artificial Intelligence',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Programming Language :: Python :: Implementation :: CPython',
         'Programming Language :: Python :: Implementation :: PyPy',
     ],
@@ -67,11 +68,15 @@ setup(
     packages=find_packages(exclude=['ez_setup', 'examples', 'test']),
     include_package_data=True,
     zip_safe=False,
+    python_requires='>=3.7',
     install_requires=[
         'opster',
         'py',
         'requests',
     ],
+    extras_require={
+        'index': ['indexed_gzip'],
+    },
     entry_points={
         'console_scripts': [
             'google-ngram-downloader = google_ngram_downloader.__main__:dispatcher.dispatch',
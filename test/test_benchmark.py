@@ -0,0 +1,60 @@
+import gzip
+
+from google_ngram_downloader import benchmark as bench, util
+from google_ngram_downloader.__main__ import benchmark
+
+import pytest
+import requests
+
+
+@pytest.fixture
+def data_dir(tmpdir):
+    return tmpdir.mkdir('data')
+
+
+def test_generate_shard(tmpdir):
+    path = str(tmpdir.join('shard.gz'))
+    bench.generate_shard(path, 3, 10 * 1024, vocabulary_size=100, seed=1)
+
+    with gzip.open(path, 'rb') as f:
+        lines = f.read().decode('utf-8').splitlines()
+
+    ngram, year, match_count, volume_count = lines[0].split(u'\t')
+    assert len(ngram.split()) == 3
+    assert 1800 <= int(year) <= 2008
+    assert len(lines) > 100
+
+
+def test_serve(data_dir):
+    data_dir.join('file.gz').write_binary(b'0123456789')
+
+    with bench.serve(str(data_dir)) as url_template:
+        assert util.URL_TEMPLATE == url_template
+        url = url_template.format('file.gz')
+
+        assert requests.get(url).content == b'0123456789'
+
+        response = requests.get(url, headers={'Range': 'bytes=4-'})
+        assert response.status_code == 206
+        assert response.content == b'456789'
+
+        assert requests.get(url, headers={'Range': 'bytes=20-'}).status_code == 416
+
+    assert util.URL_TEMPLATE != url_template
+
+
+def test_benchmark(capsys, data_dir):
+    baseline = data_dir.join('baseline.json')
+
+    args = '-d {} -s 0.02 --shards 2 -b {}'.format(data_dir, baseline)
+    benchmark.command((args + ' --save').split())
+    benchmark.command(args.split())
+
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+
+    assert [l.split()[0] for l in lines] == ['download', 'readline', 'batches', 'cooccurrence'] * 2
+    assert all(l.endswith('x') for l in lines[4:])
+
+    results = bench.load_baseline(str(baseline))
+    assert results['readline']['records'] == results['batches']['records'] == results['cooccurrence']['records'] > 0
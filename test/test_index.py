@@ -0,0 +1,137 @@
+# -*- coding: utf8 -*-
+import gzip
+import random
+
+from google_ngram_downloader import util
+from google_ngram_downloader.util import Record
+
+import pytest
+
+pytest.importorskip('indexed_gzip')
+
+from google_ngram_downloader.index import build_index, is_indexed, ShardIndex, NgramLookup
+from google_ngram_downloader.__main__ import index, lookup
+
+
+@pytest.fixture
+def ngrams():
+    return [u'w{:05} x'.format(i) for i in range(20000)] + [u'ю z']
+
+
+def write_shard(path, ngrams):
+    with gzip.open(str(path), 'wb') as f:
+        for i, ngram in enumerate(ngrams):
+            for year in range(2000, 2000 + i % 3 + 1):
+                f.write(u'{}\t{}\t{}\t1\n'.format(ngram, year, i).encode('utf-8'))
+
+
+@pytest.mark.parametrize('shuffle', (False, True))
+def test_build_index(tmpdir, ngrams, shuffle):
+    if shuffle:
+        random.Random(0).shuffle(ngrams)
+
+    path = tmpdir.join('googlebooks-eng-all-2gram-20120701-w.gz')
+    write_shard(path, ngrams)
+
+    assert not is_indexed(str(path))
+    shard_index = build_index(str(path), spacing=2 ** 16)
+    assert is_indexed(str(path))
+
+    assert shard_index.sorted != shuffle
+    assert len(shard_index.windows) > 3
+    assert shard_index.windows[0][0] == 0
+    assert all(w[1] == n[0] for w, n in zip(shard_index.windows, shard_index.windows[1:]))
+
+    with ShardIndex(str(path)) as shard_index:
+        for i in 0, 1, 2, 9999, 19999, 20000:
+            ngram = ngrams[i]
+            assert shard_index.lookup(ngram) == [
+                Record(ngram, year, i, 1) for year in range(2000, 2000 + i % 3 + 1)
+            ]
+
+        assert shard_index.lookup(u'w10000') == []
+        assert shard_index.lookup(u'a') == []
+        assert shard_index.lookup(u'zzz') == []
+
+
+def test_index_command(tmpdir, ngrams, monkeypatch, capsys):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['v', 'w'])
+    write_shard(tmpdir.join('googlebooks-eng-all-2gram-20120701-w.gz'), ngrams)
+
+    index.command('-n 2 -d {} -v --spacing 64'.format(tmpdir).split())
+    index.command('-n 2 -d {} -v --spacing 64'.format(tmpdir).split())
+
+    assert capsys.readouterr().out.splitlines() == [
+        'Indexing {}'.format(tmpdir.join('googlebooks-eng-all-2gram-20120701-w.gz')),
+        'Skipping {}'.format(tmpdir.join('googlebooks-eng-all-2gram-20120701-w.gz')),
+    ]
+    assert sorted(f.basename for f in tmpdir.listdir()) == [
+        'googlebooks-eng-all-2gram-20120701-w.gz',
+        'googlebooks-eng-all-2gram-20120701-w.gz.gzidx',
+        'googlebooks-eng-all-2gram-20120701-w.gz.ngrams.json',
+    ]
+
+
+def test_ngram_lookup(tmpdir, ngrams, monkeypatch):
+    write_shard(tmpdir.join('googlebooks-eng-all-2gram-20120701-w_.gz'), ngrams[:20000])
+    write_shard(tmpdir.join('googlebooks-eng-all-2gram-20120701-other.gz'), ngrams[20000:])
+    for fname in tmpdir.listdir():
+        build_index(str(fname), spacing=2 ** 16)
+
+    with NgramLookup(2, str(tmpdir), max_open=1) as engine:
+        results = engine.lookup_many([u'ю z', u'w00002 x', u'w99999 x', u'ю z'])
+
+        assert results == {
+            u'ю z': [Record(u'ю z', 2000, 0, 1)],
+            u'w00002 x': [Record(u'w00002 x', year, 2, 1) for year in (2000, 2001, 2002)],
+            u'w99999 x': [],
+        }
+        assert list(results) == [u'ю z', u'w00002 x', u'w99999 x']
+        assert (engine.hits, engine.misses) == (0, 3)
+        assert len(engine.shards) == 1
+
+        assert engine.lookup(u'w00002 x') == results[u'w00002 x']
+        assert (engine.hits, engine.misses) == (1, 3)
+
+        with pytest.raises(IOError):
+            engine.lookup(u'abc')
+
+    # There is no file for the 5grams that start with "qk".
+    with NgramLookup(5, str(tmpdir)) as engine:
+        assert engine.lookup(u'qkx a b c d') == []
+
+
+def test_lookup_command(tmpdir, ngrams, capsys):
+    write_shard(tmpdir.join('googlebooks-eng-all-2gram-20120701-w_.gz'), ngrams[:100])
+    index.command('-n 2 -d {}'.format(tmpdir).split())
+
+    tmpdir.join('ngrams.txt').write(u'w00005 x\nw00004 x\n\n')
+    lookup.command('-n 2 -d {} -i {}'.format(tmpdir, tmpdir.join('ngrams.txt')).split())
+    lookup.command('-n 2 -d {} -i {} -a'.format(tmpdir, tmpdir.join('ngrams.txt')).split())
+
+    assert capsys.readouterr().out.splitlines() == [
+        u'w00005 x\t2000\t5\t1',
+        u'w00005 x\t2001\t5\t1',
+        u'w00005 x\t2002\t5\t1',
+        u'w00004 x\t2000\t4\t1',
+        u'w00004 x\t2001\t4\t1',
+        u'w00005 x\t2000\t15\t3',
+        u'w00004 x\t2000\t8\t2',
+    ]
+
+
+def test_lookup_command_defaults(tmpdir, ngrams, monkeypatch, capsys):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['w'])
+    monkeypatch.chdir(tmpdir)
+
+    data_dir = tmpdir.mkdir('downloads').mkdir('google_ngrams').mkdir('1')
+    write_shard(data_dir.join('googlebooks-eng-all-1gram-20120701-w.gz'), [n.split()[0] for n in ngrams[:100]])
+    index.command([])
+
+    tmpdir.join('ngrams.txt').write(u'w00004\n')
+    lookup.command('-i {}'.format(tmpdir.join('ngrams.txt')).split())
+
+    assert capsys.readouterr().out.splitlines() == [
+        u'w00004\t2000\t4\t1',
+        u'w00004\t2001\t4\t1',
+    ]
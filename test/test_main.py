@@ -1,12 +1,14 @@
 # -*- coding: utf8 -*-
 import gzip
+import json
+import multiprocessing.pool
 import zlib
 from contextlib import contextmanager
 
 from requests import Session
 
-from google_ngram_downloader.__main__ import download, cooccurrence, readline
-from google_ngram_downloader import util
+from google_ngram_downloader.__main__ import download, cooccurrence, readline, manifest, merge
+from google_ngram_downloader import __main__ as main, util
 
 import pytest
 
@@ -47,11 +49,29 @@ def fake_request(urls, compressed_data, monkeypatch):
             def iter_content(self, chunk_size):
                 return iter(compressed_data)
 
+            def raise_for_status(self):
+                pass
+
+            def close(self):
+                pass
+
             status_code = 200
+            headers = {}
 
         return FakeRequest()
 
+    def mocked_head(self, url, **kwargs):
+        class FakeResponse:
+            def raise_for_status(self):
+                pass
+
+            status_code = 200
+            headers = {'Content-Length': str(len(b''.join(compressed_data)))}
+
+        return FakeResponse()
+
     monkeypatch.setattr(Session, 'get', mocked_get)
+    monkeypatch.setattr(Session, 'head', mocked_head)
 
 
 @pytest.mark.parametrize(
@@ -61,22 +81,71 @@ def fake_request(urls, compressed_data, monkeypatch):
         (True, 725),
     ),
 )
-def test_download(capsys, tmpdir, verbose, err_len, urls):
+@pytest.mark.parametrize('jobs', (1, 4))
+def test_download(capsys, tmpdir, verbose, err_len, urls, jobs, compressed_data):
     download.command(
-        '-o {tmpdir} -n 2 {verbose}'
+        '-o {tmpdir} -n 2 -j {jobs} {verbose}'
         ''.format(
             tmpdir=tmpdir,
+            jobs=jobs,
             verbose='-v' if verbose else '',
         ).split()
     )
 
     assert len(urls) == len(tmpdir.listdir()) == 724
+    assert tmpdir.join('googlebooks-eng-all-2gram-20120701-aa.gz').read_binary() == b''.join(compressed_data)
 
     out, err = capsys.readouterr()
     assert not out
     assert len(err.split('\n')) == err_len
 
 
+def test_download_skips_complete_files(tmpdir, urls, compressed_data):
+    download.command('-o {tmpdir} -n 2'.format(tmpdir=tmpdir).split())
+    assert len(urls) == 724
+
+    tmpdir.join('googlebooks-eng-all-2gram-20120701-aa.gz').write_binary(b'truncated')
+    download.command('-o {tmpdir} -n 2'.format(tmpdir=tmpdir).split())
+    assert urls[724:] == ['http://storage.googleapis.com/books/ngrams/books/googlebooks-eng-all-2gram-20120701-aa.gz']
+
+    download.command('-o {tmpdir} -n 2 -r'.format(tmpdir=tmpdir).split())
+    assert len(urls) == 724 * 2 + 1
+
+
+def test_download_progress_log(tmpdir, compressed_data):
+    output_dir = tmpdir.mkdir('output')
+    progress_log = tmpdir.join('progress.jsonl')
+
+    download.command(
+        '-o {output_dir} -n 2 -j 4 --progress-log {progress_log}'
+        ''.format(output_dir=output_dir, progress_log=progress_log).split()
+    )
+
+    reports = [json.loads(l) for l in progress_log.readlines()]
+    done = [r for r in reports if r['event'] == 'done']
+    size = len(b''.join(compressed_data))
+
+    assert len(done) == 724
+    assert all(r['bytes'] == r['size'] == size for r in done)
+    assert max(r['total_bytes'] for r in reports) == reports[0]['total_size'] == 724 * size
+
+
+def test_manifest(capsys, compressed_data):
+    manifest.command(['-n', '1'])
+
+    out, err = capsys.readouterr()
+    entries = [json.loads(l) for l in out.splitlines()]
+
+    assert len(entries) == 39
+    assert entries[0] == {
+        'index': '0',
+        'fname': 'googlebooks-eng-all-1gram-20120701-0.gz',
+        'url': 'http://storage.googleapis.com/books/ngrams/books/googlebooks-eng-all-1gram-20120701-0.gz',
+        'size': len(b''.join(compressed_data)),
+        'etag': None,
+    }
+
+
 def test_readline(capsys, tmpdir):
     readline.command([])
 
@@ -86,6 +155,82 @@ def test_readline(capsys, tmpdir):
     assert not err
 
 
+def test_readline_cache(capsys, tmpdir, urls, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a', 'b'])
+    cache_dir = tmpdir.join('cache')
+
+    readline.command('--cache-dir {}'.format(cache_dir).split())
+    downloaded = capsys.readouterr().out
+
+    assert len(urls) == 2
+    assert sorted(f.basename for f in cache_dir.listdir()) == [
+        'googlebooks-eng-all-2gram-20120701-a.gz',
+        'googlebooks-eng-all-2gram-20120701-a.gz.meta',
+        'googlebooks-eng-all-2gram-20120701-b.gz',
+        'googlebooks-eng-all-2gram-20120701-b.gz.meta',
+    ]
+
+    readline.command('--cache-dir {}'.format(cache_dir).split())
+
+    assert len(urls) == 2
+    assert capsys.readouterr().out == downloaded
+
+
+@pytest.mark.parametrize('compress', (0, 1))
+def test_readline_raw(capsysbinary, urls, data, compress):
+    readline.command('--raw --indices b,c --compress {}'.format(compress).split())
+
+    out, err = capsysbinary.readouterr()
+    if compress:
+        out = gzip.decompress(out)
+
+    assert out == b''.join(data) * 2
+    assert not err
+    assert [url.rsplit('-', 1)[1] for url in urls] == ['b.gz', 'c.gz']
+
+
+def test_readline_raw_filters(capsysbinary):
+    readline.command('--raw --indices a --prefix c1'.split())
+
+    assert capsysbinary.readouterr().out == b'c1 c2 WORD c3 c4\t1987\t100\t2\n'
+
+
+@pytest.mark.parametrize(
+    ('args', 'out_len', 'expected'),
+    (
+        ('-a', 4, u'analysis is often described as\t1991\t6\t3'),
+        ('--year-window 2', 5, u'analysis is often described as\t1992\t5\t2'),
+    ),
+)
+def test_readline_aggregate(capsys, monkeypatch, args, out_len, expected):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+
+    readline.command(args.split())
+
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert len(lines) == out_len
+    assert expected in lines
+
+
+@pytest.mark.parametrize(
+    ('args', 'out_len'),
+    (
+        ('--years 1992-1993', 2),
+        ('--min-match-count 20', 2),
+        ('--prefix analysis --pattern often', 3),
+        ('--prefix analysis --min-match-count 2 --years 1993', 1),
+    ),
+)
+def test_readline_filters(capsys, monkeypatch, args, out_len):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+
+    readline.command(args.split())
+
+    out, err = capsys.readouterr()
+    assert len(out.splitlines()) == out_len
+
+
 @pytest.mark.parametrize(
     'verbose',
     (
@@ -93,7 +238,8 @@ def test_readline(capsys, tmpdir):
         (True, ),
     ),
 )
-def test_cooccurrence(tmpdir, monkeypatch, verbose):
+@pytest.mark.parametrize('counter', ('dict', 'packed'))
+def test_cooccurrence(tmpdir, monkeypatch, verbose, counter):
     objects = []
 
     def modked_open(obj, *args, **kwargs):
@@ -109,9 +255,10 @@ def test_cooccurrence(tmpdir, monkeypatch, verbose):
     monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
 
     cooccurrence.command(
-        '-o {tmpdir} -n 5 --records-in-file 3 {verbose}'
+        '-o {tmpdir} -n 5 --records-in-file 3 --counter {counter} {verbose}'
         ''.format(
             tmpdir=tmpdir,
+            counter=counter,
             verbose='-v' if verbose else '',
         ).split()
     )
@@ -140,3 +287,392 @@ def test_cooccurrence(tmpdir, monkeypatch, verbose):
         u'WORD\tc3\t100',
         u'WORD\tc4\t100',
     ]
+
+
+def test_cooccurrence_compression(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+
+    for level in 1, 9:
+        cooccurrence.command(
+            '-o {} -n 5 --records-in-file 3 --compression-level {} --writer-threads 2'.format(
+                tmpdir.join(str(level)), level,
+            ).split()
+        )
+
+    def read(f_name):
+        with gzip.open(str(f_name), mode='rb') as f:
+            return f.read()
+
+    assert list(map(read, tmpdir.join('1').listdir(sort=True))) == list(map(read, tmpdir.join('9').listdir(sort=True)))
+
+
+def test_cooccurrence_workers(tmpdir, monkeypatch):
+    monkeypatch.setattr(main, 'get_indices', lambda ngram_len: ['a', 'b', 'c'])
+
+    cooccurrence.command('-o {tmpdir} -n 5 --records-in-file 3 -w 2'.format(tmpdir=tmpdir).split())
+
+    assert [f.basename for f in tmpdir.listdir(sort=True)] == [
+        'googlebooks-eng-all-5gram-20120701-{}.gz_{}.gz'.format(index, postfix)
+        for index in 'abc'
+        for postfix in (0, 1)
+    ]
+
+
+@pytest.mark.parametrize('workers', (1, 2))
+def test_cooccurrence_stats(tmpdir, monkeypatch, capsys, workers, compressed_data):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a', 'b'])
+    monkeypatch.setattr(main, 'get_indices', lambda ngram_len: ['a', 'b'])
+
+    cooccurrence.command('-o {} -n 5 -w {} --stats'.format(tmpdir, workers).split())
+
+    lines = capsys.readouterr().err.splitlines()
+    stages = dict((line.split()[0], line.split()[1:]) for line in lines[1:])
+
+    assert list(stages) == ['network', 'inflate', 'split', 'parse', 'count', 'write']
+    assert stages['network'][0] == stages['inflate'][0] == str(2 * len(compressed_data))
+    assert stages['parse'][4] == '12'
+    assert stages['write'][0] == '2'
+    assert stages['write'][4] == '22'
+
+
+def test_cooccurrence_no_stats(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+
+    def no_len(self):
+        raise AssertionError('The counter is not measured without --stats.')
+
+    monkeypatch.setattr(util.PackedCounter, '__len__', no_len)
+
+    cooccurrence.command('-o {} -n 5 --counter packed'.format(tmpdir).split())
+    assert len(tmpdir.listdir()) == 1
+
+
+@pytest.mark.parametrize('output_format', ('tsv', 'binary'))
+def test_cooccurrence_num_workers(tmpdir, monkeypatch, output_format):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a', 'b', 'c'])
+
+    manifest_file = tmpdir.join('manifest.json')
+    manifest_file.write(u''.join(
+        json.dumps({'index': index, 'url': index, 'size': size}) + u'\n'
+        for index, size in (('a', 10), ('b', 5), ('c', 5))
+    ))
+
+    for worker_id in 0, 1:
+        cooccurrence.command(
+            '-o {} -n 5 -f {} --worker-id {} --num-workers 2 --manifest {}'.format(
+                tmpdir.join(str(worker_id)), output_format, worker_id, manifest_file,
+            ).split()
+        )
+
+    extension = 'gz' if output_format == 'tsv' else 'bin'
+    assert [f.basename for f in tmpdir.join('0').listdir(lambda f: f.ext != '.vocab')] == [
+        'googlebooks-eng-all-5gram-20120701-a.gz_0.{}'.format(extension),
+    ]
+    assert [f.basename for f in tmpdir.join('1').listdir(lambda f: f.ext != '.vocab', sort=True)] == [
+        'googlebooks-eng-all-5gram-20120701-b.gz_0.{}'.format(extension),
+        'googlebooks-eng-all-5gram-20120701-c.gz_0.{}'.format(extension),
+    ]
+
+    merged = tmpdir.join('merged.gz')
+    merge.command('-i {},{} -o {}'.format(tmpdir.join('0'), tmpdir.join('1'), merged).split())
+
+    with gzip.open(str(merged), mode='rb') as f:
+        result = sorted(f.read().decode('utf-8').split(u'\n'))
+
+    assert result == [
+        u'',
+        u'REPETITION\taa\t120',
+        u'UNICODE\tу\t138',
+        u'UNICODE\tю\t138',
+        u'WORD\tc1\t300',
+        u'WORD\tc2\t300',
+        u'WORD\tc3\t300',
+        u'WORD\tc4\t300',
+        u'often\tanalysis\t18',
+        u'often\tas\t18',
+        u'often\tdescribed\t18',
+        u'often\tis\t18',
+    ]
+
+
+def test_cooccurrence_max_pairs(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+
+    output_dir = tmpdir.mkdir('output')
+    cooccurrence.command(
+        '-o {output_dir} -n 5 --max-pairs 2 --tmp-dir {tmpdir}'.format(output_dir=output_dir, tmpdir=tmpdir).split()
+    )
+
+    output_file, = output_dir.listdir()
+    assert output_file.basename == 'googlebooks-eng-all-5gram-20120701-a.gz_0.gz'
+
+    with gzip.open(str(output_file), mode='rb') as f:
+        result = sorted(f.read().decode('utf-8').split(u'\n'))
+
+    assert result == [
+        u'',
+        u'REPETITION\taa\t40',
+        u'UNICODE\tу\t46',
+        u'UNICODE\tю\t46',
+        u'WORD\tc1\t100',
+        u'WORD\tc2\t100',
+        u'WORD\tc3\t100',
+        u'WORD\tc4\t100',
+        u'often\tanalysis\t6',
+        u'often\tas\t6',
+        u'often\tdescribed\t6',
+        u'often\tis\t6',
+    ]
+
+
+def test_cooccurrence_sketch(tmpdir, monkeypatch, capsys):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+
+    cooccurrence.command(
+        '-o {} -n 5 --counter sketch --sketch-width 1024 --top-pairs 3 -v'.format(tmpdir).split()
+    )
+
+    output_file, = tmpdir.listdir()
+    with gzip.open(str(output_file), mode='rb') as f:
+        result = f.read().decode('utf-8').split(u'\n')
+
+    assert result == [u'WORD\tc1\t100', u'WORD\tc2\t100', u'WORD\tc3\t100', u'']
+    assert capsys.readouterr().out.splitlines()[-1] == (
+        'The counts are overestimated by at most 1 with the probability of 98.17%'
+    )
+
+
+def test_cooccurrence_known_words(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+
+    calls = []
+
+    def fake_frequent_words(**kwargs):
+        calls.append((kwargs['vocab_size'], kwargs['min_count']))
+        return frozenset([u'often', u'analysis', u'WORD', u'c2'])
+
+    monkeypatch.setattr(main, 'frequent_words', fake_frequent_words)
+
+    cooccurrence.command('-o {} -n 5 --vocab-size 4 --min-count 10'.format(tmpdir).split())
+
+    output_file, = tmpdir.listdir()
+    with gzip.open(str(output_file), mode='rb') as f:
+        result = sorted(f.read().decode('utf-8').split(u'\n'))
+
+    assert calls == [(4, 10)]
+    assert result == [u'', u'WORD\tc2\t100', u'often\tanalysis\t6']
+
+
+def test_cooccurrence_memory_budget(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+
+    output_dir = tmpdir.mkdir('output')
+    cooccurrence.command('-o {} -n 5 --memory-budget 0.00000001'.format(output_dir).split())
+
+    def read(f_name):
+        with gzip.open(str(f_name), mode='rb') as f:
+            return f.read().decode('utf-8').split(u'\n')[:-1]
+
+    # The budget is checked between the batches of records, the test file is a single batch.
+    output_files = output_dir.listdir(sort=True)
+    assert [len(read(f)) for f in output_files] == [11]
+    assert sorted(line for f in output_files for line in read(f))[:3] == [
+        u'REPETITION\taa\t40',
+        u'UNICODE\tу\t46',
+        u'UNICODE\tю\t46',
+    ]
+
+
+def test_cooccurrence_known_words_workers(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a', 'b'])
+    monkeypatch.setattr(main, 'get_indices', lambda ngram_len: ['a', 'b'])
+    monkeypatch.setattr(main, 'frequent_words', lambda **kwargs: frozenset([u'WORD', u'c2']))
+
+    pools = []
+    make_pool, imap = main.Pool, multiprocessing.pool.Pool.imap
+
+    def recording_pool(*args, **kwargs):
+        pools.append(kwargs['initargs'])
+        return make_pool(*args, **kwargs)
+
+    def recording_imap(self, func, iterable, chunksize=1):
+        # The words are not sent with every file.
+        assert 'known_words' not in func.keywords
+        return imap(self, func, iterable, chunksize=chunksize)
+
+    monkeypatch.setattr(main, 'Pool', recording_pool)
+    monkeypatch.setattr(multiprocessing.pool.Pool, 'imap', recording_imap)
+
+    cooccurrence.command('-o {} -n 5 -w 2 --vocab-size 2'.format(tmpdir).split())
+
+    assert pools == [(frozenset([u'WORD', u'c2']), )]
+    for output_file in tmpdir.listdir():
+        with gzip.open(str(output_file), mode='rb') as f:
+            assert f.read().decode('utf-8') == u'WORD\tc2\t100\n'
+
+
+def test_cooccurrence_known_words_empty_chunk(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+    monkeypatch.setattr(main, 'frequent_words', lambda **kwargs: frozenset([u'WORD', u'c1']))
+
+    cooccurrence.command('-o {} -n 5 --records-in-file 3 --vocab-size 2'.format(tmpdir).split())
+
+    # The first chunk has only the records of "analysis is often described as".
+    output_file, = tmpdir.listdir()
+    assert output_file.basename == 'googlebooks-eng-all-5gram-20120701-a.gz_0.gz'
+    with gzip.open(str(output_file), mode='rb') as f:
+        assert f.read().decode('utf-8') == u'WORD\tc1\t100\n'
+
+
+def test_cooccurrence_skip_prefetch(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+    tmpdir.join('googlebooks-eng-all-5gram-20120701-a.gz_0.gz').write_binary(b'')
+
+    data = gzip.compress(b'analysis is often described as\t1991\t1\t1\n' * 10000)
+    read = []
+
+    def mocked_get(self, url, **kwargs):
+        class FakeRequest:
+            def iter_content(self, chunk_size):
+                for i in range(0, len(data), 16):
+                    read.append(i)
+                    yield data[i:i + 16]
+
+            def close(self):
+                pass
+
+            status_code = 200
+            headers = {}
+
+        return FakeRequest()
+
+    monkeypatch.setattr(Session, 'get', mocked_get)
+
+    cooccurrence.command('-o {} -n 5 --prefetch 2'.format(tmpdir).split())
+
+    # The file is skipped because of the existing output, it is not downloaded.
+    assert len(read) < 10 < len(data) // 16
+
+
+def test_cooccurrence_resume(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+
+    write_cooccurrence_file = main.write_cooccurrence_file
+    written = []
+
+    def crashing_write(output_file, *args, **kwargs):
+        if written:
+            raise IOError("No space left on device")
+        written.append(output_file)
+        write_cooccurrence_file(output_file, *args, **kwargs)
+
+    monkeypatch.setattr(main, 'write_cooccurrence_file', crashing_write)
+
+    output_dir = tmpdir.mkdir('output')
+    args = '-o {} -n 5 --records-in-file 2'.format(output_dir).split()
+    with pytest.raises(IOError):
+        cooccurrence.command(args)
+
+    assert sorted(f.basename for f in output_dir.listdir()) == [
+        'googlebooks-eng-all-5gram-20120701-a.gz.checkpoint.json',
+        'googlebooks-eng-all-5gram-20120701-a.gz_0.gz',
+    ]
+    assert json.loads(output_dir.join('googlebooks-eng-all-5gram-20120701-a.gz.checkpoint.json').read()) == {
+        'postfix': 1,
+        'records': 2,
+    }
+
+    monkeypatch.setattr(main, 'write_cooccurrence_file', write_cooccurrence_file)
+    cooccurrence.command(args)
+
+    expected_dir = tmpdir.mkdir('expected')
+    cooccurrence.command('-o {} -n 5 --records-in-file 2'.format(expected_dir).split())
+
+    def read(f_name):
+        with gzip.open(str(f_name), mode='rb') as f:
+            return sorted(f.read().decode('utf-8').split(u'\n'))
+
+    assert [f.basename for f in output_dir.listdir(sort=True)] == [f.basename for f in expected_dir.listdir(sort=True)]
+    assert list(map(read, output_dir.listdir(sort=True))) == list(map(read, expected_dir.listdir(sort=True)))
+    assert len(output_dir.listdir()) == 3
+
+
+def test_cooccurrence_resume_first_file(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+
+    save_checkpoint = main.save_checkpoint
+
+    def crashing_save(path, checkpoint):
+        if checkpoint['postfix']:
+            raise IOError('No space left on device')
+        save_checkpoint(path, checkpoint)
+
+    monkeypatch.setattr(main, 'save_checkpoint', crashing_save)
+
+    output_dir = tmpdir.mkdir('output')
+    args = '-o {} -n 5 --records-in-file 2'.format(output_dir).split()
+    with pytest.raises(IOError):
+        cooccurrence.command(args)
+
+    # The first output is written, but the checkpoint after it is not.
+    assert json.loads(output_dir.join('googlebooks-eng-all-5gram-20120701-a.gz.checkpoint.json').read()) == {
+        'postfix': 0,
+        'records': 0,
+    }
+
+    monkeypatch.setattr(main, 'save_checkpoint', save_checkpoint)
+    cooccurrence.command(args)
+
+    assert [f.basename for f in output_dir.listdir(sort=True)] == [
+        'googlebooks-eng-all-5gram-20120701-a.gz_{}.gz'.format(postfix) for postfix in range(3)
+    ]
+
+
+def test_cooccurrence_vocabulary(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a', 'b'])
+
+    output_dir = tmpdir.mkdir('output')
+    vocabulary = tmpdir.join('vocabulary.txt')
+    cooccurrence.command(
+        '-o {output_dir} -n 5 --vocabulary {vocabulary}'.format(output_dir=output_dir, vocabulary=vocabulary).split()
+    )
+
+    id2word = vocabulary.read_text('utf-8').split(u'\n')
+    assert id2word[:6] == [u'often', u'analysis', u'is', u'described', u'as', u'WORD']
+    assert len(id2word) == len(set(id2word)) == 15 + 1
+
+    def read(f_name):
+        with gzip.open(str(f_name), mode='rb') as f:
+            lines = f.read().decode('utf-8').split(u'\n')[:-1]
+        return sorted(
+            u'{}\t{}\t{}'.format(id2word[int(i)], id2word[int(c)], v)
+            for i, c, v in (l.split(u'\t') for l in lines)
+        )
+
+    result_a, result_b = map(read, output_dir.listdir(sort=True))
+    assert result_a == result_b
+    assert result_a[:2] == [u'REPETITION\taa\t40', u'UNICODE\tу\t46']
+
+
+def test_cooccurrence_binary(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, 'get_indices', lambda ngram_len: ['a'])
+
+    cooccurrence.command('-o {tmpdir} -n 5 -f binary --sort'.format(tmpdir=tmpdir).split())
+
+    output_file = tmpdir.join('googlebooks-eng-all-5gram-20120701-a.gz_0.bin')
+    id2word = output_file.new(ext='.vocab').read_text('utf-8').split(u'\n')[:-1]
+    matrix = util.read_cooccurrence_binary(str(output_file))
+
+    assert matrix.sorted
+    result = [
+        u'{}\t{}\t{}'.format(id2word[i], id2word[c], v)
+        for i, c, v in zip(matrix.item_ids, matrix.context_ids, matrix.counts)
+    ]
+    assert result[:5] == [
+        u'often\tanalysis\t6',
+        u'often\tis\t6',
+        u'often\tdescribed\t6',
+        u'often\tas\t6',
+        u'WORD\tc1\t100',
+    ]
+    assert len(result) == 11
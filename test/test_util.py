@@ -1,7 +1,43 @@
+# -*- coding: utf8 -*-
+import gzip
+import os
+import time
+
+import requests
+
+from google_ngram_downloader import util
 from google_ngram_downloader.util import (
+    Record,
     get_indices,
+    ngram_index,
+    partition_indices,
     ngram_to_cooc,
+    frequent_words,
     count_coccurrence,
+    BatchChunks,
+    count_coccurrence_batches,
+    iter_ngram_counts,
+    slice_batch,
+    aggregate_records,
+    PairCounter,
+    PackedCounter,
+    SpillingCounter,
+    SketchCounter,
+    download_file,
+    download_file_segmented,
+    ShardCache,
+    write_cooccurrence_binary,
+    read_cooccurrence_binary,
+    parse_batch,
+    iter_records,
+    line_filter,
+    StreamInterruptionError,
+    Stats,
+    GzipWriter,
+    prefetch_files,
+    skip_lines,
+    add_stats_hook,
+    remove_stats_hook,
 )
 
 import pytest
@@ -29,6 +65,41 @@ def test_get_indices_5grams(bigrams_indices):
     assert set(indices) == (bigrams_indices - set(['qk']))
 
 
+@pytest.mark.parametrize(
+    ('ngram', 'ngram_len', 'expected'),
+    (
+        (u'Analysis is', 2, 'an'),
+        (u'a dog', 2, 'a_'),
+        (u"o'clock is", 2, 'o_'),
+        (u'book_NOUN is', 2, 'bo'),
+        (u'book', 1, 'b'),
+        (u'1984 was', 2, '1'),
+        (u'_NOUN_ is', 2, '_NOUN_'),
+        (u'_NOUN_', 1, 'pos'),
+        (u'. The', 2, 'punctuation'),
+        (u'ю z', 2, 'other'),
+        (u'', 1, 'other'),
+    ),
+)
+def test_ngram_index(ngram, ngram_len, expected):
+    assert ngram_index(ngram, ngram_len) == expected
+    assert expected in set(get_indices(ngram_len))
+
+
+@pytest.mark.parametrize(
+    ('sizes', 'num_workers', 'expected'),
+    (
+        ([('a', 10), ('b', 5), ('c', 5)], 2, [['a'], ['b', 'c']]),
+        ([('a', 1), ('b', 5), ('c', 3), ('d', 2), ('e', 4)], 3, [['b'], ['a', 'e'], ['c', 'd']]),
+        ([('a', None), ('b', 4), ('c', None), ('d', 4)], 2, [['a', 'c'], ['b', 'd']]),
+        ([('a', None), ('b', None), ('c', None)], 2, [['a', 'c'], ['b']]),
+        ([('a', 1)], 3, [['a'], [], []]),
+    ),
+)
+def test_partition_indices(sizes, num_workers, expected):
+    assert partition_indices(sizes, num_workers) == expected
+
+
 @pytest.mark.parametrize(
     ('ngram', 'expected_result', 'index'),
     (
@@ -59,6 +130,58 @@ def test_ngrams_to_cooc(ngram, expected_result, index):
     assert result == expected_result
 
 
+def test_ngrams_to_cooc_known_words():
+    index = {}
+    known_words = frozenset([u'BB', u'aa'])
+
+    assert ngram_to_cooc(u'aa zz BB yz aa', 3, index, known_words) == (((0, 1), 3), ((0, 1), 3))
+    assert ngram_to_cooc(u'aa zz yz BB aa', 3, index, known_words) == ()
+    assert index == {u'BB': 0, u'aa': 1}
+
+
+def test_frequent_words(monkeypatch):
+    def fake_readline(ngram_len, **kwargs):
+        assert ngram_len == 1
+        yield 'fname', 'url', iter([
+            Record(u'a', 2000, 5, 1),
+            Record(u'a', 2001, 5, 1),
+            Record(u'b', 2000, 20, 1),
+            Record(u'c', 2000, 3, 1),
+        ])
+        yield 'fname', 'url', iter([Record(u'd', 2000, 1, 1)])
+
+    monkeypatch.setattr(util, 'readline_google_store', fake_readline)
+
+    assert frequent_words() == frozenset([u'a', u'b', u'c', u'd'])
+    assert frequent_words(vocab_size=2) == frozenset([u'a', u'b'])
+    assert frequent_words(min_count=3) == frozenset([u'a', u'b', u'c'])
+    assert frequent_words(vocab_size=2, min_count=15) == frozenset([u'b'])
+
+
+@pytest.mark.parametrize(
+    ('year_window', 'expected'),
+    (
+        (
+            None,
+            [
+                Record('a BB z', 1987, 1110, 3),
+                Record('a ABCDEFG z', 1989, 222, 1),
+            ],
+        ),
+        (
+            2,
+            [
+                Record('a BB z', 1986, 10, 1),
+                Record('a BB z', 1988, 1100, 2),
+                Record('a ABCDEFG z', 1988, 222, 1),
+            ],
+        ),
+    ),
+)
+def test_aggregate_records(records, year_window, expected):
+    assert list(aggregate_records(records, year_window=year_window)) == expected
+
+
 def test_count_coccurrence(records):
     index = {}
     assert count_coccurrence(records, index) == {
@@ -67,3 +190,544 @@ def test_count_coccurrence(records):
         (index['ABCDEFG'], index['a']): 222,
         (index['ABCDEFG'], index['z']): 222,
     }
+
+
+def test_count_coccurrence_packed(records):
+    index = {}
+    counter = count_coccurrence(records, index, counter=PackedCounter())
+
+    assert counter == {
+        (index['BB'], index['a']): 1110,
+        (index['BB'], index['z']): 1110,
+        (index['ABCDEFG'], index['a']): 222,
+        (index['ABCDEFG'], index['z']): 222,
+    }
+
+
+def make_batch(*ngrams):
+    return parse_batch(b'\n'.join(u'{}\t2000\t{}\t1'.format(n, i + 1).encode('utf-8') for i, n in enumerate(ngrams)))
+
+
+def test_iter_ngram_counts():
+    batch = make_batch(u'a BB z', u'a BB z', u'ю z', u'a BB z')
+    assert list(iter_ngram_counts(batch)) == [(u'a BB z', 3), (u'ю z', 3), (u'a BB z', 4)]
+    assert list(iter_records(slice_batch(batch, 1, 3))) == list(iter_records(batch))[1:3]
+    assert list(iter_records(slice_batch(batch, 2))) == list(iter_records(batch))[2:]
+
+
+def test_count_coccurrence_batches(records):
+    batches = [
+        parse_batch(b'\n'.join(u'{}\t{}\t{}\t{}'.format(*r).encode('utf-8') for r in records[:2])),
+        parse_batch(b'\n'.join(u'{}\t{}\t{}\t{}'.format(*r).encode('utf-8') for r in records[2:])),
+    ]
+
+    index = {}
+    assert count_coccurrence_batches(iter(batches), index) == count_coccurrence(records, {})
+    assert list(index) == ['BB', 'a', 'z', 'ABCDEFG']
+
+
+@pytest.mark.parametrize(
+    ('options', 'expected'),
+    (
+        ({}, [(6, ['ABCDEFG', 'BB', 'CC', 'a', 'z'])]),
+        ({'records_in_file': 2}, [(2, ['BB', 'a', 'z']), (2, ['ABCDEFG', 'BB', 'a', 'z']), (2, ['CC', 'a', 'z'])]),
+        ({'records_in_file': 4}, [(4, ['ABCDEFG', 'BB', 'a', 'z']), (2, ['CC', 'a', 'z'])]),
+        # Every counter is over the budget, so a chunk ends with the ngram of the end of a batch.
+        ({'memory_budget': 1}, [(3, ['BB', 'a', 'z']), (3, ['ABCDEFG', 'CC', 'a', 'z'])]),
+        (
+            {'memory_budget': 1, 'records_in_file': 2},
+            [(2, ['BB', 'a', 'z']), (2, ['ABCDEFG', 'BB', 'a', 'z']), (2, ['CC', 'a', 'z'])],
+        ),
+        ({'memory_budget': 10 ** 9}, [(6, ['ABCDEFG', 'BB', 'CC', 'a', 'z'])]),
+    ),
+)
+def test_batch_chunks(options, expected):
+    batches = [
+        make_batch(u'a BB z', u'a BB z'),
+        make_batch(u'a BB z', u'a ABCDEFG z', u'a CC z'),
+        make_batch(u'a CC z'),
+    ]
+    chunks = BatchChunks(iter(batches), **options)
+
+    counted = []
+    while True:
+        counter = PairCounter()
+        index = {}
+        count_coccurrence_batches(chunks.take(counter), index, counter=counter)
+        if not counter:
+            break
+        counted.append((chunks.records, sorted(index)))
+
+    assert counted == expected
+
+
+def test_counter_memory_usage():
+    pairs = [((i, i + 1), 1) for i in range(1000)]
+
+    counter = PairCounter()
+    empty = counter.memory_usage()
+    counter.add_pairs(pairs)
+    assert counter.memory_usage() > empty + 1000 * 100
+
+    packed = PackedCounter(buffer_size=10)
+    packed.add_pairs(pairs)
+    assert 1000 * 16 <= packed.memory_usage() < counter.memory_usage()
+
+    assert SketchCounter(width=1024, depth=2).memory_usage() >= 1024 * 2 * 8
+
+
+def test_packed_counter():
+    counter = PackedCounter(buffer_size=3)
+    pairs = [((i % 7, 2 ** 32 - 1 - i % 5), i) for i in range(100)]
+    counter.add_pairs(pairs)
+
+    expected = {}
+    for pair, count in pairs:
+        expected[pair] = expected.get(pair, 0) + count
+
+    assert counter[(3, 2 ** 32 - 1 - 4)] == expected[(3, 2 ** 32 - 1 - 4)]
+    assert (7, 0) not in counter
+    assert list(counter.items()) == sorted(expected.items())
+    assert len(counter) == len(expected)
+
+
+def test_spilling_counter(tmpdir):
+    counter = SpillingCounter(max_pairs=4, directory=str(tmpdir))
+    counter.block_size = 3
+
+    pairs = [((i % 7, i % 5), i) for i in range(100)]
+    counter.add_pairs(pairs)
+
+    expected = {}
+    for pair, count in pairs:
+        expected[pair] = expected.get(pair, 0) + count
+
+    assert counter._spilled
+    assert list(counter.items()) == sorted(expected.items())
+    assert counter == expected
+
+
+def test_sketch_counter():
+    counter = SketchCounter(width=1024, depth=3, top=4)
+    assert not counter
+
+    pairs = [((i % 10, i % 3), 1) for i in range(1000)] + [((100, 1), 500), ((101, 2), 400)]
+    counter.add_pairs(pairs)
+
+    expected = {}
+    for pair, count in pairs:
+        expected[pair] = expected.get(pair, 0) + count
+
+    error_bound, probability = counter.bounds()
+    assert counter.total == sum(expected.values())
+    assert error_bound == pytest.approx(2.718281828 / 1024 * counter.total)
+    assert probability == pytest.approx(0.95, abs=0.01)
+
+    assert len(counter) == 4
+    assert list(counter)[:2] == [(100, 1), (101, 2)]
+    for pair, count in counter.items():
+        assert expected[pair] <= count <= expected[pair] + error_bound
+        assert counter[pair] == count
+    for pair, count in expected.items():
+        assert count <= counter.estimate(pair)
+
+    with pytest.raises(KeyError):
+        counter[(1000, 1000)]
+
+
+def test_download_file_retries(tmpdir):
+    attempts = []
+
+    class FakeRequest(object):
+        status_code = 200
+
+        def __init__(self, headers):
+            self.headers = headers
+
+        def raise_for_status(self):
+            pass
+
+        def iter_content(self, chunk_size):
+            return iter([b'abc'])
+
+    class FakeSession(object):
+        def get(self, url, **kwargs):
+            attempts.append(url)
+
+            if len(attempts) == 1:
+                raise requests.ConnectionError()
+            if len(attempts) == 2:
+                # The stream ends before the announced length.
+                return FakeRequest({'Content-Length': '6'})
+            return FakeRequest({'Content-Length': '3'})
+
+    path = tmpdir.join('file.gz')
+    download_file(FakeSession(), 'http://example.com/file.gz', str(path), delay=0)
+
+    assert len(attempts) == 3
+    assert path.read_binary() == b'abc'
+    assert tmpdir.listdir() == [path]
+
+
+def test_download_file_gives_up(tmpdir):
+    class FakeSession(object):
+        def get(self, url, **kwargs):
+            raise requests.ConnectionError()
+
+    path = tmpdir.join('file.gz')
+    with pytest.raises(requests.ConnectionError):
+        download_file(FakeSession(), 'http://example.com/file.gz', str(path), retries=2, delay=0)
+
+    assert not path.check()
+
+
+def test_download_file_resumes(tmpdir):
+    data = b'0123456789'
+    ranges = []
+
+    class FakeRequest(object):
+        def __init__(self, status_code, content):
+            self.status_code = status_code
+            self.content = content
+            self.headers = {'Content-Length': str(len(content))}
+
+        def raise_for_status(self):
+            pass
+
+        def iter_content(self, chunk_size):
+            return iter([self.content])
+
+    class FakeSession(object):
+        def get(self, url, headers, **kwargs):
+            ranges.append(headers.get('Range'))
+
+            if 'Range' in headers:
+                start = int(headers['Range'][len('bytes='):-1])
+                return FakeRequest(206, data[start:])
+            return FakeRequest(200, data)
+
+    path = tmpdir.join('file.gz')
+    tmpdir.join('file.gz.part').write_binary(data[:4])
+
+    assert download_file(FakeSession(), 'http://example.com/file.gz', str(path), delay=0)
+    assert ranges == ['bytes=4-']
+    assert path.read_binary() == data
+    assert tmpdir.listdir() == [path]
+
+
+class RangeSession(object):
+    """A session that serves byte ranges of the data and fails the first request of the given ranges."""
+
+    def __init__(self, data, failing=()):
+        self.data = data
+        self.failing = set(failing)
+        self.ranges = []
+
+    def head(self, url, **kwargs):
+        return RangeResponse(200, b'', {'Content-Length': str(len(self.data))})
+
+    def get(self, url, headers, **kwargs):
+        start, end = map(int, headers['Range'][len('bytes='):].split('-'))
+        self.ranges.append((start, end))
+
+        if (start, end) in self.failing:
+            self.failing.remove((start, end))
+            # The stream ends in the middle of the range.
+            return RangeResponse(206, self.data[start:start + 1])
+
+        return RangeResponse(206, self.data[start:end + 1])
+
+
+class RangeResponse(object):
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {'Content-Length': str(len(content))}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        return (self.content[i:i + chunk_size] for i in range(0, len(self.content), chunk_size))
+
+
+def test_download_file_segmented(tmpdir):
+    data = bytes(bytearray(range(256))) * 4
+    session = RangeSession(data, failing=[(256, 511)])
+
+    path = tmpdir.join('file.gz')
+    assert download_file_segmented(session, 'http://example.com/file.gz', str(path), chunk_size=100, delay=0)
+
+    assert path.read_binary() == data
+    assert tmpdir.listdir() == [path]
+    assert sorted(session.ranges) == [(0, 255), (256, 511), (257, 511), (512, 767), (768, 1023)]
+
+    assert not download_file_segmented(session, 'http://example.com/file.gz', str(path), chunk_size=100)
+
+
+def test_download_file_segmented_resumes(tmpdir):
+    data = bytes(bytearray(range(256))) * 4
+    session = RangeSession(data, failing=[(0, 511)])
+
+    path = tmpdir.join('file.gz')
+    with pytest.raises(StreamInterruptionError):
+        download_file_segmented(
+            session, 'http://example.com/file.gz', str(path), segments=2, chunk_size=100, retries=0, delay=0,
+        )
+
+    assert sorted(f.basename for f in tmpdir.listdir()) == ['file.gz.part', 'file.gz.part.json']
+
+    session.ranges = []
+    assert download_file_segmented(session, 'http://example.com/file.gz', str(path), segments=2, chunk_size=100)
+
+    assert session.ranges == [(1, 511)]
+    assert path.read_binary() == data
+    assert tmpdir.listdir() == [path]
+
+
+def test_shard_cache(tmpdir):
+    session = RangeSession(b'0123456789')
+    session.get = lambda url, **kwargs: RangeResponse(200, b'0123456789')
+
+    cache = ShardCache(str(tmpdir), max_size=25)
+
+    def read(fname):
+        return b''.join(cache.open(session, fname, 'http://example.com/' + fname).iter_content(3))
+
+    for fname in 'googlebooks-a.gz', 'googlebooks-b.gz':
+        assert read(fname) == b'0123456789'
+    assert len(tmpdir.listdir()) == 4
+
+    # A file is cached only if it's read to the end.
+    next(cache.open(session, 'googlebooks-x.gz', 'http://example.com/x').iter_content(3))
+    assert len(tmpdir.listdir()) == 4
+
+    # The least recently used file is removed.
+    time.sleep(0.01)
+    read('googlebooks-a.gz')
+    read('googlebooks-c.gz')
+    assert sorted(f.basename for f in tmpdir.listdir() if f.ext == '.gz') == ['googlebooks-a.gz', 'googlebooks-c.gz']
+
+    # A file that differs from the remote one is downloaded again.
+    tmpdir.join('googlebooks-a.gz').write_binary(b'01234')
+    assert read('googlebooks-a.gz') == b'0123456789'
+    assert tmpdir.join('googlebooks-a.gz').read_binary() == b'0123456789'
+
+
+def test_shard_cache_evict_shared(tmpdir, monkeypatch):
+    for i, fname in enumerate(('googlebooks-a.gz', 'googlebooks-b.gz', 'googlebooks-c.gz')):
+        tmpdir.join(fname).write_binary(b'0123456789')
+        tmpdir.join(fname + '.meta').write(u'{}')
+        os.utime(str(tmpdir.join(fname)), (1000 + i, 1000 + i))
+    cache = ShardCache(str(tmpdir), max_size=15)
+
+    # Another process removes the files while they are evicted.
+    listdir, remove = os.listdir, os.remove
+    monkeypatch.setattr(util.os, 'listdir', lambda path: listdir(path) + ['googlebooks-gone.gz'])
+
+    def concurrent_remove(path):
+        remove(path)
+        remove(path)
+
+    monkeypatch.setattr(util.os, 'remove', concurrent_remove)
+    cache.evict()
+
+    assert sorted(listdir(str(tmpdir))) == ['googlebooks-c.gz', 'googlebooks-c.gz.meta']
+
+
+def test_parse_batch():
+    batch = parse_batch(b'a BB z\t1987\t10\t1\n\xd1\x8e z\t1988\t100\t2')
+
+    assert batch.ngrams == b'a BB z\xd1\x8e z'
+    assert list(batch.offsets) == [0, 6, 10]
+    assert list(batch.year) == [1987, 1988]
+    assert list(batch.match_count) == [10, 100]
+    assert list(batch.volume_count) == [1, 2]
+
+    assert list(iter_records(batch)) == [
+        Record(u'a BB z', 1987, 10, 1),
+        Record(u'ю z', 1988, 100, 2),
+    ]
+
+
+@pytest.mark.parametrize('threads', (1, 3))
+def test_gzip_writer(tmpdir, threads):
+    path = tmpdir.join('output.gz')
+    lines = [u'{}\t{}\n'.format(i, i * i).encode('utf-8') for i in range(10000)]
+
+    with GzipWriter(str(path), level=1, block_size=1000, threads=threads) as f:
+        for line in lines:
+            f.write(line)
+
+    with gzip.open(str(path), 'rb') as f:
+        assert f.read() == b''.join(lines)
+
+
+def test_gzip_writer_empty(tmpdir):
+    path = tmpdir.join('output.gz')
+    GzipWriter(str(path)).close()
+
+    with gzip.open(str(path), 'rb') as f:
+        assert f.read() == b''
+
+
+def test_prefetch_files():
+    produced = []
+
+    def chunks(name):
+        for i in range(5):
+            produced.append((name, i))
+            yield i
+
+    files = prefetch_files(((name, 'url', chunks(name)) for name in 'abc'), 2)
+
+    fname, url, file_chunks = next(files)
+    assert (fname, url, next(file_chunks)) == ('a', 'url', 0)
+
+    # The chunks are read ahead, but not more than the size of the queue allows.
+    while len(produced) < 3:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert len(produced) == 4
+
+    # The rest of the chunks of a file are skipped.
+    assert [(fname, list(file_chunks)) for fname, _, file_chunks in files] == [
+        ('b', [0, 1, 2, 3, 4]),
+        ('c', [0, 1, 2, 3, 4]),
+    ]
+
+
+def test_prefetch_files_skip():
+    produced = []
+    closed = []
+
+    def chunks(name):
+        try:
+            for i in range(100):
+                produced.append((name, i))
+                yield i
+        finally:
+            closed.append(name)
+
+    files = prefetch_files(((name, 'url', chunks(name)) for name in 'ab'), 2)
+
+    fname, _, file_chunks = next(files)
+    assert (fname, next(file_chunks)) == ('a', 0)
+
+    # The download of a skipped file stops.
+    fname, _, file_chunks = next(files)
+    assert fname == 'b'
+    assert closed == ['a']
+    assert len([name for name, _ in produced if name == 'a']) <= 5
+    assert list(file_chunks) == list(range(100))
+
+
+def test_prefetch_files_error():
+    def chunks():
+        yield b'a'
+        raise requests.ConnectionError()
+
+    files = prefetch_files([('a', 'url', chunks())], 2)
+    fname, _, file_chunks = next(files)
+
+    assert next(file_chunks) == b'a'
+    with pytest.raises(requests.ConnectionError):
+        next(file_chunks)
+
+
+def test_stats(records):
+    calls = []
+
+    def hook(*args):
+        calls.append(args)
+
+    add_stats_hook(hook)
+    try:
+        with Stats() as stats:
+            parse_batch(b'a BB z\t1987\t10\t1\n\xd1\x8e z\t1988\t100\t2')
+            count_coccurrence(records, {})
+    finally:
+        remove_stats_hook(hook)
+
+    assert [call[0] for call in calls] == ['split', 'parse', 'count']
+
+    totals = stats.as_dict()
+    assert sorted(totals) == ['count', 'parse', 'split']
+    assert totals['split']['bytes_in'] == 32
+    assert totals['parse']['records'] == 2
+    assert totals['count']['records'] == len(records)
+    assert totals['count']['calls'] == 1
+
+    summary = stats.summary().splitlines()
+    assert [line.split()[0] for line in summary] == ['stage', 'split', 'parse', 'count']
+
+    # Nothing is reported once the hooks are removed.
+    parse_batch(b'a BB z\t1987\t10\t1')
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize('sort', (False, True))
+def test_cooccurrence_binary(tmpdir, sort):
+    items = [((3, 1), 10), ((0, 2 ** 32 - 1), 2 ** 40), ((0, 1), 1)]
+    path = str(tmpdir.join('cooccurrence.bin'))
+
+    write_cooccurrence_binary(path, items, sort=sort)
+    matrix = read_cooccurrence_binary(path)
+
+    expected = sorted(items) if sort else items
+    assert matrix.sorted == sort
+    assert list(zip(zip(matrix.item_ids, matrix.context_ids), matrix.counts)) == expected
+
+
+def test_cooccurrence_binary_empty(tmpdir):
+    path = str(tmpdir.join('cooccurrence.bin'))
+
+    write_cooccurrence_binary(path, [])
+    matrix = read_cooccurrence_binary(path)
+
+    assert len(matrix.item_ids) == len(matrix.context_ids) == len(matrix.counts) == 0
+
+
+@pytest.mark.parametrize(
+    ('filters', 'expected'),
+    (
+        ({}, None),
+        ({'prefix': u'aa'}, [True, True, False, False]),
+        ({'pattern': u'b{2}'}, [False, True, False, False]),
+        ({'pattern': u'^c.*\\d$'}, [False, False, True, False]),
+        ({'exclude_pos': True}, [False, True, True, False]),
+        ({'years': (1990, 2000)}, [True, False, True, True]),
+        ({'min_match_count': 10}, [False, True, False, True]),
+        ({'years': (1990, 2000), 'min_match_count': 10, 'exclude_pos': True}, [False, False, False, False]),
+        ({'prefix': u'ю'}, [False, False, False, True]),
+    ),
+)
+def test_line_filter(filters, expected):
+    lines = (
+        b'aa_DET ab\t1990\t3\t1',
+        b'aa bb c3\t1980\t30\t1',
+        b'c1 c2\t2000\t1\t1',
+        b'\xd1\x8e _NOUN_\t1995\t10\t1',
+    )
+
+    accept = line_filter(**filters)
+
+    if expected is None:
+        assert accept is None
+    else:
+        assert [accept(line) for line in lines] == expected
+
+
+@pytest.mark.parametrize(
+    ('n', 'expected'),
+    (
+        (0, [b'a\nb', b'c', b'd\ne\nf']),
+        (1, [b'b', b'c', b'd\ne\nf']),
+        (2, [b'c', b'd\ne\nf']),
+        (4, [b'e\nf']),
+        (6, []),
+        (7, []),
+    ),
+)
+def test_skip_lines(n, expected):
+    assert list(skip_lines([b'a\nb', b'c', b'd\ne\nf'], n)) == expected